@@ -1,5 +1,5 @@
 from flask import Flask, render_template, jsonify, request
-from revrec import connect_db, process_invoice
+from recognition import connect_db, process_invoice
 from seed import seed_db
 from models import Invoice
 from helpers import pretty_date
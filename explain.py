@@ -0,0 +1,145 @@
+import sys
+from datetime import datetime
+from models import Invoice, InvoiceItem, Payment, Refund, TermExtension
+from ledger import partitions, partition_name, ledger_db
+
+"""
+-------------------
+HOT QUERIES
+-------------------
+"""
+def hot_queries(obs_date=datetime(2014,1,1)):
+    """Returns the queries that recognition runs and ledger reads issue most, with
+    sample values taken from the db. Ledger queries are run against the latest ledger
+    partition up to the reporting date, and left out if there is none.
+
+    :param obs_date: Reporting date.
+    :return list. Tuples of (name, collection, query, projection, sort, covered), where
+                  covered is True if the query is meant to be answered from the index alone.
+    """
+    invoices = Invoice._get_collection()
+    items = InvoiceItem._get_collection()
+    payments = Payment._get_collection()
+    refunds = Refund._get_collection()
+    extensions = TermExtension._get_collection()
+    invoice_id = sample_value(invoices, 'invoice_id')
+    ids_only = {'invoice_id': True, '_id': False}
+
+    queries = [
+        ('invoices to recognize', invoices, {'invoice_date': {'$lte': obs_date}}, None, None, False),
+        ('job chunk boundaries', invoices, {'invoice_date': {'$lte': obs_date}}, ids_only,
+         [('invoice_id', 1)], True),
+        ('items of an invoice', items, {'invoice_id': invoice_id}, None, None, False),
+        ('payment of an invoice', payments,
+         {'invoice_id': invoice_id, 'payment_date': {'$lte': obs_date}}, None, None, False),
+        ('refunds of an invoice', refunds,
+         {'invoice_id': invoice_id, 'refund_date': {'$lte': obs_date}}, None, None, False),
+        ('term extensions of an invoice', extensions,
+         {'invoice_id': invoice_id, 'grant_date': {'$lte': obs_date}}, None, None, False),
+        ('items in service after a close', items, {'service_end': {'$gt': obs_date}}, ids_only,
+         None, True),
+        ('payments after a close', payments, {'payment_date': {'$gt': obs_date}}, ids_only, None, True),
+        ('refunds after a close', refunds, {'refund_date': {'$gt': obs_date}}, ids_only, None, True),
+        ('term extensions after a close', extensions, {'grant_date': {'$gt': obs_date}}, ids_only,
+         None, True),
+        ('term extensions in service after a close', extensions, {'service_end': {'$gt': obs_date}},
+         ids_only, None, True),
+    ]
+
+    periods = partitions(last=(obs_date.year, obs_date.month))
+    if not periods:
+        return queries
+
+    year, month = periods[-1]
+    entries = ledger_db()[partition_name(year, month)]
+    account_id = sample_value(entries, 'account_id')
+    item_id = sample_value(entries, 'invoice_item_id')
+    return queries + [
+        ('entries of an account', entries, {'account_id': account_id}, None, None, False),
+        ('items of a month', entries, {'year': year, 'month': month},
+         {'invoice_item_id': True, '_id': False}, None, True),
+        ('entries of an item', entries, {'invoice_item_id': item_id}, None, None, False),
+        ('stale entries of a chunk', entries,
+         {'invoice_id': {'$gte': invoice_id}, 'run_token': {'$ne': None}}, None, None, False),
+    ]
+
+def sample_value(collection, field):
+    """
+    :return A value of the field from some document of the collection, or None if empty.
+    """
+    doc = collection.find_one({}, fields={field: True})
+    return doc.get(field) if doc else None
+
+"""
+-------------------
+QUERY PLANS
+-------------------
+"""
+def explain_hot_queries(obs_date=datetime(2014,1,1)):
+    """Explains every hot query and flags collection scans, and queries meant to be
+    covered that still fetch documents.
+
+    :param obs_date: Reporting date.
+    :return list. Problems found, as strings. Empty if all plans are as intended.
+    """
+    problems = []
+    for name, collection, query, fields, sort, covered in hot_queries(obs_date):
+        cursor = collection.find(query, fields=fields)
+        if sort:
+            cursor.sort(sort)
+        explanation = cursor.explain()
+
+        scan = is_collection_scan(explanation)
+        index_only = is_index_only(explanation)
+        print '%-32s %-12s %s' % (name, 'COLLSCAN' if scan else 'index',
+                                  'covered' if index_only else '')
+
+        if scan:
+            problems.append('%s: collection scan on %s' % (name, collection.name))
+        elif covered and not index_only:
+            problems.append('%s: not covered by an index' % name)
+    return problems
+
+def is_collection_scan(explanation):
+    """
+    :param explanation: Output of Cursor.explain.
+    :return boolean. True if the winning plan scans the collection.
+    """
+    # Before MongoDB 3.0, explain reports the cursor type
+    if 'cursor' in explanation:
+        return explanation['cursor'].startswith('BasicCursor')
+    return 'COLLSCAN' in plan_stages(explanation['queryPlanner']['winningPlan'])
+
+def is_index_only(explanation):
+    """
+    :param explanation: Output of Cursor.explain.
+    :return boolean. True if the query is answered from an index without fetching documents.
+    """
+    if 'indexOnly' in explanation:
+        return explanation['indexOnly']
+    stages = plan_stages(explanation['queryPlanner']['winningPlan'])
+    return 'IXSCAN' in stages and 'FETCH' not in stages
+
+def plan_stages(plan):
+    """
+    :param plan: A query plan stage from explain, with its input stages.
+    :return list. Names of the stage and all of its input stages.
+    """
+    stages = [plan['stage']]
+    for child in plan.get('inputStages', []) + ([plan['inputStage']] if 'inputStage' in plan else []):
+        stages.extend(plan_stages(child))
+    return stages
+
+"""
+-------------------------
+COMMAND LINE EXECUTABLE
+-------------------------
+"""
+if __name__ == '__main__':
+    from recognition import connect_db
+    connect_db()
+
+    problems = explain_hot_queries()
+    for problem in problems:
+        print problem
+    sys.exit(1 if problems else 0)
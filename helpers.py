@@ -19,6 +19,22 @@ def daterange(start_date, end_date):
     for n in range(days_elapsed(start_date, end_date)):
         yield start_date + timedelta(n)
 
+def chunked(iterable, size):
+    """A generator that groups an iterable into lists of at most the specified size,
+    without reading ahead more than one group.
+
+    :param iterable: Any iterable, e.g. a cursor.
+    :param size: Maximum number of elements per group.
+    """
+    group = []
+    for element in iterable:
+        group.append(element)
+        if len(group) == size:
+            yield group
+            group = []
+    if group:
+        yield group
+
 def days_elapsed(start_date, end_date):
     """
     :param start_date: Start date of calculation.
@@ -102,4 +118,15 @@ def gen_id():
     """Returns a randomized 8-character numeric id.
     :return string. A randomized id.
     """
-    return ''.join(random.choice('0123456789') for i in range(8))
\ No newline at end of file
+    return ''.join(random.choice('0123456789') for i in range(8))
+
+"""
+-------------------
+ERRORS
+-------------------
+"""
+class RevrecError(ValueError):
+    """An operation refused because it would break the rules of the ledger, e.g. closing
+    a period twice or resuming a superseded job. The command line reports it without a
+    traceback.
+    """
\ No newline at end of file
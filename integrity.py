@@ -0,0 +1,261 @@
+import sys
+import cPickle as pickle
+from array import array
+from models import InvoiceItem, Payment, ItemSnapshot
+from ledger import iter_entries
+
+FLOAT_FIELDS = ['cr_rev', 'ending_defrev', 'cr_ref_payable', 'dr_reserve_ref', 'dr_contra_rev',
+                'dr_defrev', 'dr_reserve_graceperiod', 'cr_contra_rev']
+
+DEBIT_FIELDS = ['dr_defrev', 'dr_reserve_ref', 'dr_contra_rev', 'dr_reserve_graceperiod']
+CREDIT_FIELDS = ['cr_rev', 'cr_ref_payable', 'cr_contra_rev']
+
+TOLERANCE = 0.005
+
+"""
+-------------------
+COLUMNAR LEDGER
+-------------------
+"""
+def load_ledger():
+    """Loads the ledger partitions into columns, sorted by invoice item and month.
+    Only the ledger fields are read, through a projection.
+
+    :return dict. 'invoice_item_id' is a list, 'year' and 'month' are integer arrays
+                  and every amount field is a float array, all aligned by row.
+    """
+    fields = dict((f, True) for f in ['invoice_item_id', 'year', 'month'] + FLOAT_FIELDS)
+    fields['_id'] = False
+    entries = iter_entries(fields=fields)
+
+    columns = new_columns()
+    try:
+        for doc in entries:
+            columns['invoice_item_id'].append(doc.get('invoice_item_id'))
+            columns['year'].append(doc['year'])
+            columns['month'].append(doc['month'])
+            for f in FLOAT_FIELDS:
+                columns[f].append(doc.get(f) or 0)
+    finally:
+        entries.close()
+    return columns
+
+def new_columns():
+    """
+    :return dict. Empty ledger columns.
+    """
+    columns = {'invoice_item_id': [], 'year': array('l'), 'month': array('l')}
+    for f in FLOAT_FIELDS:
+        columns[f] = array('d')
+    return columns
+
+def export_ledger(path):
+    """Writes the ledger to a columnar export file.
+
+    :param path: Path of the export file.
+    :return int. Number of rows exported.
+    """
+    columns = load_ledger()
+    with open(path, 'wb') as f:
+        pickle.dump(columns, f, pickle.HIGHEST_PROTOCOL)
+    return len(columns['year'])
+
+def load_export(path):
+    """
+    :param path: Path of a columnar export file, see export_ledger.
+    :return dict. Ledger columns.
+    """
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def load_item_terms():
+    """Loads what the invariants need to know about each invoice item: its amount and
+    the month in which its invoice was paid, i.e. deferred revenue was booked.
+
+    :return dict. Keyed on item id, values are (total_amount, (year, month) or None).
+    """
+    payment_months = {}
+    for doc in Payment._get_collection().find({}, fields={'invoice_id': True,
+                                                          'payment_date': True,
+                                                          '_id': False}):
+        payment_months[doc['invoice_id']] = (doc['payment_date'].year, doc['payment_date'].month)
+
+    terms = {}
+    for doc in InvoiceItem._get_collection().find({}, fields={'item_id': True,
+                                                              'invoice_id': True,
+                                                              'total_amount': True,
+                                                              '_id': False}):
+        terms[doc['item_id']] = (doc['total_amount'], payment_months.get(doc['invoice_id']))
+    return terms
+
+def load_snapshots():
+    """Loads the item snapshots of the latest close, which carry the balances of the
+    months that archive_periods dropped from the ledger.
+
+    :return dict. Keyed on item id, values are ((year, month), ending_defrev, totals) as of
+                  the snapshot, totals being keyed on the fields of the tie_out check.
+    """
+    snapshots = {}
+    for doc in ItemSnapshot._get_collection().find({}, fields={'_id': False}):
+        totals = {'cr_rev': doc.get('cumul_rev') or 0,
+                  'dr_contra_rev': doc.get('contra_rev') or 0,
+                  'dr_reserve_ref': doc.get('reserve_ref') or 0,
+                  'cr_ref_payable': doc.get('ref_payable') or 0}
+        snapshots[doc['invoice_item_id']] = ((doc['year'], doc['month']), doc['ending_defrev'] or 0,
+                                             totals)
+    return snapshots
+
+"""
+-------------------
+INVARIANTS
+-------------------
+"""
+def check_ledger(columns, terms, tolerance=TOLERANCE, snapshots=None):
+    """Checks the ledger invariants for every invoice item and every month:
+
+        balanced:     debits equal credits within the month.
+        duplicate:    at most one entry per item and month.
+        roll_forward: ending deferred revenue equals the prior month's balance, plus
+                      the item amount in the month of payment, less debits to deferred
+                      revenue.
+        tie_out:      in the item's last month, revenue net of contra-revenue and refund
+                      reserves, plus deferred revenue, plus refunds payable equals the
+                      item amount.
+
+    Each invariant is a single pass over the columns. Items with a snapshot start from
+    the balances it implies, see opening_balances, so that items whose first months were
+    archived still roll forward and tie out.
+
+    :param columns: Ledger columns sorted by item and month, see load_ledger.
+    :param terms: Item amounts and payment months, see load_item_terms.
+    :param tolerance: Largest absolute difference that is not reported.
+    :param snapshots: Item snapshots, see load_snapshots. Items open at zero if None.
+    :return list. Violations as dicts with the item, year, month, check, expected and
+                  actual values.
+    """
+    violations = []
+    rows = len(columns['year'])
+    items = columns['invoice_item_id']
+    years = columns['year']
+    months = columns['month']
+
+    def report(n, check, expected, actual):
+        if abs(expected - actual) > tolerance:
+            violations.append({'invoice_item_id': items[n],
+                               'year': years[n],
+                               'month': months[n],
+                               'check': check,
+                               'expected': expected,
+                               'actual': actual})
+
+    # Debits equal credits
+    debits = [sum(row) for row in zip(*[columns[f] for f in DEBIT_FIELDS])]
+    credits = [sum(row) for row in zip(*[columns[f] for f in CREDIT_FIELDS])]
+    for n, (dr, cr) in enumerate(zip(debits, credits)):
+        report(n, 'balanced', dr, cr)
+
+    # Rows of the same item are adjacent; first_row marks the start of each item's run
+    first_row = [n == 0 or items[n] != items[n - 1] for n in range(rows)]
+    last_row = first_row[1:] + [True]
+    openings = opening_balances(columns, terms, snapshots or {}, first_row)
+
+    # One entry per item and month
+    for n in range(1, rows):
+        if not first_row[n] and (years[n], months[n]) == (years[n - 1], months[n - 1]):
+            report(n, 'duplicate', 0, 1)
+
+    # Deferred revenue rolls forward month to month
+    ending = columns['ending_defrev']
+    dr_defrev = columns['dr_defrev']
+    for n in range(rows):
+        amount, payment_month = terms.get(items[n], (0, None))
+        if first_row[n]:
+            prior = openings[n][0] if n in openings else 0
+        else:
+            prior = ending[n - 1]
+        booked = amount if payment_month == (years[n], months[n]) else 0
+        report(n, 'roll_forward', prior + booked - dr_defrev[n], ending[n])
+
+    # Revenue, deferred revenue and refunds tie back to the item amount
+    totals = dict((f, 0) for f in ['cr_rev', 'dr_contra_rev', 'dr_reserve_ref', 'cr_ref_payable'])
+    for n in range(rows):
+        if first_row[n]:
+            totals = dict(openings[n][1]) if n in openings else dict((f, 0) for f in totals)
+        for f in totals:
+            totals[f] += columns[f][n]
+        if last_row[n]:
+            amount = terms.get(items[n], (0, None))[0]
+            net = (totals['cr_rev'] - totals['dr_contra_rev'] - totals['dr_reserve_ref'] +
+                   ending[n] + totals['cr_ref_payable'])
+            report(n, 'tie_out', amount, net)
+
+    return violations
+
+def opening_balances(columns, terms, snapshots, first_row):
+    """Derives the balances of items with a snapshot before their first month in the
+    ledger. A snapshot holds the balances at the end of the latest closed period, so
+    these are the snapshot balances less the item's activity in the ledger through that
+    period. Items whose months are all in the ledger thereby open at zero, up to any
+    difference between the ledger and the snapshot, which the checks then report.
+
+    :param columns: Ledger columns sorted by item and month, see load_ledger.
+    :param terms: Item amounts and payment months, see load_item_terms.
+    :param snapshots: Item snapshots, see load_snapshots.
+    :param first_row: For every row, True if it is the first row of its item.
+    :return dict. Keyed on the first row of each item with a snapshot, values are the
+                  ending deferred revenue and the totals of the tie_out fields before it.
+    """
+    openings = {}
+    rows = len(first_row)
+    items = columns['invoice_item_id']
+    years = columns['year']
+    months = columns['month']
+    for n in range(rows):
+        if not first_row[n] or items[n] not in snapshots:
+            continue
+        period, ending, totals = snapshots[items[n]]
+        totals = dict(totals)
+        amount, payment_month = terms.get(items[n], (0, None))
+
+        m = n
+        while m < rows and (m == n or not first_row[m]) and (years[m], months[m]) <= period:
+            booked = amount if payment_month == (years[m], months[m]) else 0
+            ending -= booked - columns['dr_defrev'][m]
+            for f in totals:
+                totals[f] -= columns[f][m]
+            m += 1
+        openings[n] = (ending, totals)
+    return openings
+
+def print_violations(violations, limit=50):
+    """Prints a summary of violations by check and the first few violations.
+
+    :param violations: Violations, see check_ledger.
+    :param limit: Maximum number of violations to print.
+    """
+    counts = {}
+    for v in violations:
+        counts[v['check']] = counts.get(v['check'], 0) + 1
+    print '%s violations found. %s' % (len(violations), counts)
+
+    for v in violations[:limit]:
+        print '%(check)s: item %(invoice_item_id)s, %(year)s-%(month)02d, expected %(expected).4f, actual %(actual).4f' % v
+
+"""
+-------------------------
+COMMAND LINE EXECUTABLE
+-------------------------
+"""
+if __name__ == '__main__':
+    from recognition import connect_db
+    connect_db()
+
+    if len(sys.argv) > 1:
+        columns = load_export(sys.argv[1])
+    else:
+        columns = load_ledger()
+
+    print 'Checking %s monthly entries...' % len(columns['year'])
+    violations = check_ledger(columns, load_item_terms(), snapshots=load_snapshots())
+    print_violations(violations)
+    sys.exit(1 if violations else 0)
@@ -0,0 +1,154 @@
+from datetime import datetime
+from helpers import gen_id, chunked, RevrecError
+from models import RecognitionJob, JobChunk, Invoice, LedgerRun
+from ledger import begin_run, commit_run, finish_run
+from periods import latest_close
+from recognition import (iter_invoices, iter_monthly_entries, write_monthly_entries,
+                    CURSOR_BATCH_SIZE, MAX_IN_FLIGHT)
+
+CHUNK_SIZE = 10000
+
+"""
+-------------------
+RECOGNITION JOBS
+-------------------
+"""
+def recognize_revenue_job(obs_date=datetime(2014,1,1), job_id=None, chunk_size=CHUNK_SIZE,
+                          batch_size=CURSOR_BATCH_SIZE, max_in_flight=MAX_IN_FLIGHT):
+    """Runs revenue recognition as a resumable job. If job_id refers to an existing
+    job, the job is resumed from its first unfinished chunk, otherwise a new job
+    is planned. A job cannot be resumed once another run has written to the ledger
+    since it started, as its remaining chunks would overwrite newer output. Jobs
+    recompute every period, so none runs once a period is closed.
+
+    :param obs_date: Reporting date. Ignored when resuming, the job keeps its own.
+    :param job_id: Id of the job to resume.
+    :param chunk_size: Number of invoices per chunk when planning a new job.
+    :param batch_size: Number of invoices fetched per cursor round trip.
+    :param max_in_flight: Maximum number of invoices whose entries are held in memory.
+    :return string. The job id.
+    """
+    close = latest_close()
+    if close is not None:
+        raise RevrecError('Periods through %s-%02d are closed, a job would recompute them.'
+                          % (close.year, close.month))
+
+    job = None
+    if job_id is not None:
+        job = RecognitionJob.objects(job_id=job_id).first()
+    if job is not None and (job.status == 'superseded' or later_run(job) is not None):
+        raise RevrecError('Job %s was superseded by a later run.' % job.job_id)
+    if job is None:
+        job = start_job(obs_date=obs_date, chunk_size=chunk_size, job_id=job_id)
+
+    run_job(job, batch_size=batch_size, max_in_flight=max_in_flight)
+    return job.job_id
+
+def start_job(obs_date=datetime(2014,1,1), chunk_size=CHUNK_SIZE, job_id=None):
+    """Creates a recognition job and persists its chunk plan.
+
+    :param obs_date: Reporting date of the job.
+    :param chunk_size: Number of invoices per chunk.
+    :param job_id: Id of the job. Generated if not specified.
+    :return RecognitionJob.
+    """
+    job = RecognitionJob(job_id=job_id or gen_id(),
+                         obs_date=obs_date,
+                         created=datetime.now(),
+                         status='running')
+    job.save()
+
+    for chunk_no, (lower, upper) in enumerate(plan_chunks(obs_date, chunk_size)):
+        JobChunk(job_id=job.job_id,
+                 chunk_no=chunk_no,
+                 lower=lower,
+                 upper=upper,
+                 status='pending').save()
+
+    print 'Started job %s.' % job.job_id
+    return job
+
+def plan_chunks(obs_date=datetime(2014,1,1), chunk_size=CHUNK_SIZE):
+    """Splits the invoice keyspace into ranges of roughly chunk_size invoices each.
+    Boundaries are taken from a scan of sorted invoice ids, so only the ids are read.
+
+    :param obs_date: Reporting date.
+    :param chunk_size: Number of invoices per chunk.
+    :return list. Tuples of (lower, upper) invoice id bounds. The first lower and the
+                  last upper bound are None, so the ranges cover the whole keyspace.
+    """
+    cursor = Invoice._get_collection().find({'invoice_date': {'$lte': obs_date}},
+                                            fields={'invoice_id': True, '_id': False},
+                                            timeout=False)
+    cursor.sort('invoice_id').batch_size(CURSOR_BATCH_SIZE)
+
+    # Each chunk after the first starts at the first invoice id of its group
+    first_ids = []
+    try:
+        for group in chunked((doc['invoice_id'] for doc in cursor), chunk_size):
+            first_ids.append(group[0])
+    finally:
+        cursor.close()
+
+    bounds = [None] + first_ids[1:] + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+def later_run(job):
+    """
+    :param job: RecognitionJob object.
+    :return LedgerRun. A run started after the job by anything but the job, or None.
+    """
+    return LedgerRun.objects(started__gt=job.created, job_id__ne=job.job_id).first()
+
+def run_job(job, batch_size=CURSOR_BATCH_SIZE, max_in_flight=MAX_IN_FLIGHT):
+    """Processes the unfinished chunks of a job in order. Finished chunks are skipped.
+    If a chunk failed after its commit, its cleanup is finished by the next run, see
+    ledger.recover_runs.
+
+    :param job: RecognitionJob object.
+    :param batch_size: Number of invoices fetched per cursor round trip.
+    :param max_in_flight: Maximum number of invoices whose entries are held in memory.
+    """
+    for chunk in JobChunk.objects(job_id=job.job_id).order_by('chunk_no'):
+        if chunk.status == 'done':
+            continue
+
+        written = run_chunk(job, chunk, batch_size=batch_size, max_in_flight=max_in_flight)
+        print 'Job %s: chunk %s done, %s monthly entries written.' % (job.job_id,
+                                                                      chunk.chunk_no,
+                                                                      written)
+
+    RecognitionJob.objects(job_id=job.job_id).update_one(set__status='done',
+                                                         set__completed=datetime.now())
+
+def run_chunk(job, chunk, batch_size=CURSOR_BATCH_SIZE, max_in_flight=MAX_IN_FLIGHT):
+    """Recognizes revenue on the invoices of a chunk and replaces the chunk's output.
+
+    New entries are written under the token of a ledger run scoped to the chunk's
+    invoices, and stay hidden from readers until the run commits. The commit hides the
+    chunk's earlier output at the same time, see ledger.commit_run. The chunk is then
+    checkpointed and the replaced entries are removed.
+
+    :param job: RecognitionJob object.
+    :param chunk: JobChunk object.
+    :param batch_size: Number of invoices fetched per cursor round trip.
+    :param max_in_flight: Maximum number of invoices whose entries are held in memory.
+    :return int. Number of monthly entries written.
+    """
+    run_token = begin_run(job_id=job.job_id, lower=chunk.lower, upper=chunk.upper)
+    invoices = iter_invoices(obs_date=job.obs_date, batch_size=batch_size,
+                             lower=chunk.lower, upper=chunk.upper)
+
+    written = 0
+    for group in chunked(invoices, max_in_flight):
+        written += write_monthly_entries(iter_monthly_entries(group, obs_date=job.obs_date,
+                                                              run_token=run_token))
+
+    commit_run(run_token)
+    JobChunk.objects(job_id=job.job_id, chunk_no=chunk.chunk_no).update_one(
+        set__status='done',
+        set__run_token=run_token,
+        set__completed=datetime.now())
+
+    finish_run(run_token)
+    return written
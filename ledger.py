@@ -0,0 +1,377 @@
+import re
+import uuid
+import heapq
+from datetime import datetime
+from itertools import groupby
+from helpers import chunked
+from models import MonthlyEntry, LedgerRun, RecognitionJob
+
+# Monthly entries are stored in one collection per period, e.g. monthly_entry_2012_03
+PARTITION_PREFIX = 'monthly_entry_'
+STAGING_SUFFIX = '_staging'
+_PARTITION_NAME = re.compile(r'^%s(\d{4})_(\d{2})$' % PARTITION_PREFIX)
+
+# Collection of the ledger before it was partitioned
+LEGACY_COLLECTION = 'monthly_entry'
+LEGACY_BATCH_SIZE = 1000
+
+"""
+-------------------
+PARTITIONS
+-------------------
+"""
+def partition_name(year, month):
+    """
+    :return string. Name of the partition of a period.
+    """
+    return '%s%04d_%02d' % (PARTITION_PREFIX, year, month)
+
+def partition_period(name):
+    """
+    :param name: A collection name.
+    :return tuple. (year, month) of the partition, or None if the collection is not a partition.
+    """
+    match = _PARTITION_NAME.match(name)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def ledger_db():
+    """
+    :return Pymongo db object holding the ledger partitions.
+    """
+    return MonthlyEntry._get_db()
+
+def partitions(first=None, last=None):
+    """
+    :param first: (year, month) of the first period, or None if unbounded.
+    :param last: (year, month) of the last period, or None if unbounded.
+    :return list. (year, month) of every existing partition from first to last, in order.
+    """
+    periods = [partition_period(name) for name in ledger_db().collection_names()]
+    return sorted(p for p in periods
+                  if p is not None and (first is None or p >= first) and (last is None or p <= last))
+
+def partition(year, month):
+    """
+    :return Collection. The partition of a period, created with its indexes if it does not exist.
+    """
+    collection = ledger_db()[partition_name(year, month)]
+    ensure_indexes(collection)
+    return collection
+
+def ensure_indexes(collection):
+    """Creates the indexes declared on MonthlyEntry on a partition. mongoengine keeps
+    them in _meta as built specs, e.g. {'fields': [('account_id', 1), ...]}.
+    """
+    for spec in MonthlyEntry._meta['indexes']:
+        collection.ensure_index(spec['fields'])
+
+"""
+-------------------
+READS AND WRITES
+-------------------
+"""
+def insert_entries(docs):
+    """Bulk inserts monthly entry documents into the partitions of their periods, with one
+    insert per period. Inserts are acknowledged, so that a run commits only once all of
+    its entries are stored, see commit_run.
+
+    :param docs: List of documents, as produced by MonthlyEntry.to_mongo.
+    :return int. Number of documents written.
+    """
+    period = lambda doc: (doc['year'], doc['month'])
+    for (year, month), group in groupby(sorted(docs, key=period), period):
+        partition(year, month).insert(list(group), safe=True)
+    return len(docs)
+
+def remove_entries(query, first=None, last=None):
+    """Removes the monthly entries that match the query from the partitions of the
+    periods from first to last.
+
+    :param query: Mongo query.
+    :param first: (year, month) of the first period, or None if unbounded.
+    :param last: (year, month) of the last period, or None if unbounded.
+    """
+    for year, month in partitions(first, last):
+        ledger_db()[partition_name(year, month)].remove(query, safe=True)
+
+def iter_entries(query=None, fields=None, first=None, last=None):
+    """A generator over the monthly entry documents of the periods from first to last
+    that match the query, in (invoice_item_id, year, month) order. Only the partitions
+    of these periods are read. Each is read in item order through its index and the
+    partitions are merged, with one cursor open per partition until the generator is
+    exhausted or discarded.
+
+    Entries hidden by unfinished runs are skipped, see visible_query.
+
+    :param query: Mongo query. All entries if None.
+    :param fields: Projection, as for Collection.find.
+    :param first: (year, month) of the first period, or None if unbounded.
+    :param last: (year, month) of the last period, or None if unbounded.
+    """
+    runs = unfinished_runs()
+    cursors = []
+    try:
+        streams = []
+        for year, month in partitions(first, last):
+            collection = ledger_db()[partition_name(year, month)]
+            cursor = collection.find(visible_query(query, year, month, runs), fields=fields,
+                                     timeout=False)
+            cursor.sort('invoice_item_id')
+            cursors.append(cursor)
+            streams.append(keyed_entries(cursor, year, month))
+
+        for item_id, year, month, n, doc in heapq.merge(*streams):
+            yield doc
+    finally:
+        for cursor in cursors:
+            cursor.close()
+
+def keyed_entries(cursor, year, month):
+    """
+    :return generator. Tuples of (invoice_item_id, year, month, n, document) for the
+                       documents of a partition, n being the position in the cursor.
+    """
+    for n, doc in enumerate(cursor):
+        yield doc.get('invoice_item_id'), year, month, n, doc
+
+"""
+-------------------
+RUNS
+-------------------
+"""
+# A run writes its entries under a fresh token while registered as pending, then commits
+# by flipping its LedgerRun to committed in a single document update. Readers apply the
+# registry through visible_query, so they see either the entries the run replaces or
+# the run's output, never both and never a partial run. Removing the replaced entries
+# after the commit is cleanup only. Runs do not overlap: each one first settles what an
+# earlier, failed run left behind.
+
+def begin_run(job_id=None, lower=None, upper=None, invoice_ids=None, first=None, last=None):
+    """Settles earlier runs, see recover_runs, and registers a pending run.
+
+    :param job_id: Id of the recognition job the run belongs to, if any.
+    :param lower: Inclusive lower invoice id bound of the scope, or None.
+    :param upper: Exclusive upper invoice id bound of the scope, or None.
+    :param invoice_ids: If set, the scope is limited to these invoice ids.
+    :param first: (year, month) of the first period of the scope, or None if unbounded.
+    :param last: (year, month) of the last period of the scope, or None if unbounded.
+    :return string. Run token to stamp on the entries of the run.
+    """
+    recover_runs()
+    return record_run(uuid.uuid4().hex, status='pending', job_id=job_id, lower=lower, upper=upper,
+                      invoice_ids=invoice_ids, first=first, last=last)
+
+def record_run(run_token, status='done', job_id=None, lower=None, upper=None, invoice_ids=None,
+               first=None, last=None):
+    """Registers a run. A run that replaced its output by other means, e.g. swap_partition,
+    is recorded as done, after calling recover_runs before it started writing. Unfinished
+    recognition jobs other than job_id are superseded by the run, so they cannot be resumed.
+
+    :param run_token: Token stamped on the entries of the run.
+    :param status: 'pending' or 'done'.
+    :return string. The run token.
+    """
+    RecognitionJob.objects(status='running', job_id__ne=job_id).update(set__status='superseded')
+    first_year, first_month = first or (None, None)
+    last_year, last_month = last or (None, None)
+    LedgerRun(run_token=run_token,
+              job_id=job_id,
+              status=status,
+              started=datetime.now(),
+              lower=lower,
+              upper=upper,
+              invoice_ids=list(invoice_ids or []),
+              first_year=first_year,
+              first_month=first_month,
+              last_year=last_year,
+              last_month=last_month).save()
+    return run_token
+
+def commit_run(run_token):
+    """Makes the entries of a pending run visible and hides the entries they replace,
+    in a single document update. This is the commit point of the run.
+    """
+    LedgerRun.objects(run_token=run_token, status='pending').update_one(set__status='committed')
+
+def finish_run(run_token):
+    """Removes the entries that a committed run replaced, then marks the run done.
+    """
+    run = LedgerRun.objects(run_token=run_token).first()
+    query = scope_query(run)
+    query['run_token'] = {'$ne': run.run_token}
+    remove_entries(query, *run_periods(run))
+    LedgerRun.objects(run_token=run_token).update_one(set__status='done')
+
+def recover_runs():
+    """Settles what failed runs left behind. A committed run that did not finish its
+    cleanup is finished, and the entries of a run that never committed are removed.
+    """
+    for run in LedgerRun.objects(status='committed').order_by('started'):
+        finish_run(run.run_token)
+    for run in LedgerRun.objects(status='pending'):
+        remove_entries({'run_token': run.run_token}, *run_periods(run))
+        LedgerRun.objects(run_token=run.run_token).update_one(set__status='aborted')
+
+def unfinished_runs():
+    """
+    :return list. Pending and committed LedgerRun objects.
+    """
+    return list(LedgerRun.objects(status__in=['pending', 'committed']))
+
+def visible_query(query, year, month, runs):
+    """Adds the entries that unfinished runs hide to a query on a partition: the entries
+    of pending runs, and the entries in the scope of committed runs that these replace.
+
+    :param query: Mongo query, or None.
+    :param year: Year of the partition.
+    :param month: Month of the partition.
+    :param runs: Unfinished runs, see unfinished_runs.
+    :return dict. Mongo query.
+    """
+    hidden = []
+    for run in runs:
+        first, last = run_periods(run)
+        if (first is not None and (year, month) < first) or (last is not None and (year, month) > last):
+            continue
+        if run.status == 'pending':
+            hidden.append({'run_token': run.run_token})
+        else:
+            condition = scope_query(run)
+            condition['run_token'] = {'$ne': run.run_token}
+            hidden.append(condition)
+
+    if not hidden:
+        return query or {}
+    if not query:
+        return {'$nor': hidden}
+    return {'$and': [query, {'$nor': hidden}]}
+
+def scope_query(run):
+    """
+    :param run: LedgerRun object.
+    :return dict. Mongo query on the invoice ids in the scope of the run.
+    """
+    conditions = []
+    if run.lower is not None or run.upper is not None:
+        invoice_id_range = {}
+        if run.lower is not None:
+            invoice_id_range['$gte'] = run.lower
+        if run.upper is not None:
+            invoice_id_range['$lt'] = run.upper
+        conditions.append({'invoice_id': invoice_id_range})
+    if run.invoice_ids:
+        conditions.append({'invoice_id': {'$in': run.invoice_ids}})
+
+    if len(conditions) > 1:
+        return {'$and': conditions}
+    return conditions[0] if conditions else {}
+
+def run_periods(run):
+    """
+    :param run: LedgerRun object.
+    :return tuple. (year, month) of the first and the last period of the scope of the run,
+                   each None if unbounded.
+    """
+    first = (run.first_year, run.first_month) if run.first_year is not None else None
+    last = (run.last_year, run.last_month) if run.last_year is not None else None
+    return first, last
+
+"""
+-------------------
+PERIOD OPERATIONS
+-------------------
+"""
+def staging_partition(year, month):
+    """
+    :return Collection. An empty staging collection for a period, with the indexes of a
+                        partition. Left over staging output of a failed run is dropped.
+    """
+    collection = ledger_db()[partition_name(year, month) + STAGING_SUFFIX]
+    collection.drop()
+    ensure_indexes(collection)
+    return collection
+
+def swap_partition(staging, year, month):
+    """Replaces the partition of a period with a staging collection in a single rename,
+    so that readers see either the old or the new entries of the period, never a mix.
+
+    :param staging: Collection, see staging_partition.
+    """
+    staging.rename(partition_name(year, month), dropTarget=True)
+
+def stage_entries(docs, staging):
+    """Bulk inserts monthly entry documents into the staging collections of their periods,
+    with one acknowledged insert per period, see insert_entries. A period's staging
+    collection is created on first use, see staging_partition.
+
+    :param docs: List of documents, as produced by MonthlyEntry.to_mongo.
+    :param staging: Dictionary of staging collections keyed on (year, month). Updated in place.
+    :return int. Number of documents written.
+    """
+    period = lambda doc: (doc['year'], doc['month'])
+    for key, group in groupby(sorted(docs, key=period), period):
+        if key not in staging:
+            staging[key] = staging_partition(*key)
+        staging[key].insert(list(group), safe=True)
+    return len(docs)
+
+def swap_partitions(staging, first=None, last=None):
+    """Replaces the partitions of the periods from first to last with their staging
+    collections, one period at a time, see swap_partition. Partitions of periods without
+    a staging collection are dropped.
+
+    :param staging: Dictionary of staging collections keyed on (year, month), see stage_entries.
+    :param first: (year, month) of the first period, or None if unbounded.
+    :param last: (year, month) of the last period, or None if unbounded.
+    :return list. (year, month) of the dropped partitions.
+    """
+    for (year, month), collection in sorted(staging.iteritems()):
+        swap_partition(collection, year, month)
+    dropped = [p for p in partitions(first, last) if p not in staging]
+    for year, month in dropped:
+        ledger_db().drop_collection(partition_name(year, month))
+    return dropped
+
+def drop_partitions(first=None, last=None):
+    """Drops the partitions of the periods from first to last whole.
+
+    :param first: (year, month) of the first period, or None if unbounded.
+    :param last: (year, month) of the last period, or None if unbounded.
+    :return list. (year, month) of the dropped partitions.
+    """
+    dropped = partitions(first, last)
+    for year, month in dropped:
+        ledger_db().drop_collection(partition_name(year, month))
+    return dropped
+
+def split_legacy_collection():
+    """Moves the entries of the unpartitioned monthly_entry collection into partitions
+    and drops it. A no-op if it does not exist.
+
+    :return int. Number of entries moved.
+    """
+    db = ledger_db()
+    if LEGACY_COLLECTION not in db.collection_names():
+        return 0
+
+    cursor = db[LEGACY_COLLECTION].find(timeout=False)
+    moved = 0
+    try:
+        for docs in chunked(cursor, LEGACY_BATCH_SIZE):
+            moved += insert_entries(docs)
+    finally:
+        cursor.close()
+
+    db.drop_collection(LEGACY_COLLECTION)
+    return moved
+
+"""
+-------------------------
+COMMAND LINE EXECUTABLE
+-------------------------
+"""
+if __name__ == '__main__':
+    from recognition import connect_db
+    connect_db()
+
+    print '%s monthly entries moved into partitions.' % split_legacy_collection()
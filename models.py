@@ -2,7 +2,14 @@ from mongoengine import *
 from helpers import pretty_date
 
 class MonthlyEntry(Document):
+    """
+    A monthly ledger entry of an invoice item. Entries are stored in one collection
+    per period, see ledger.py, and these indexes are created on each of them.
+    """
     account_id = StringField()
+    invoice_id = StringField()
+    invoice_item_id = StringField()
+    run_token = StringField()
     year = IntField()
     month = IntField()
     cr_rev = FloatField()
@@ -15,7 +22,11 @@ class MonthlyEntry(Document):
     dr_reserve_graceperiod = FloatField()
     cr_contra_rev = FloatField()
     meta = {
-        'indexes': ['year', 'month']
+        'allow_inheritance': False,
+        'indexes': [('account_id', 'year', 'month'),
+                    ('year', 'month', 'invoice_item_id'),
+                    ('invoice_item_id', 'year', 'month'),
+                    ('invoice_id', 'run_token')]
     }
 
 class Invoice(Document):
@@ -27,14 +38,18 @@ class Invoice(Document):
     invoice_date = DateTimeField()
     invoice_amount = FloatField()
     meta = {
-        'indexes': ['invoice_id', 'invoice_date']
+        'allow_inheritance': False,
+        'indexes': ['invoice_date', ('invoice_id', 'invoice_date')]
     }
 
-    def is_paid(self):
+    def is_paid(self, payment=None):
         """
         Returns true if total invoice amount equals total payment amount.
+
+        :param payment: Payment of this invoice, if already retrieved by the caller.
         """
-        payment = Payment.objects(invoice_id=self.invoice_id).first()
+        if payment is None:
+            payment = Payment.objects(invoice_id=self.invoice_id).first()
 
         if payment and payment.amount == self.invoice_amount:
             return True 
@@ -59,7 +74,8 @@ class InvoiceItem(Document):
     billperiod = StringField()
     acct_code = StringField()
     meta = {
-        'indexes': ['invoice_id']
+        'allow_inheritance': False,
+        'indexes': ['invoice_id', ('service_end', 'invoice_id')]
     }
 
 class Payment(Document):
@@ -71,7 +87,8 @@ class Payment(Document):
     payment_date = DateTimeField()
     amount = FloatField()
     meta = {
-        'indexes': ['invoice_id', 'payment_date']
+        'allow_inheritance': False,
+        'indexes': [('invoice_id', 'payment_date'), ('payment_date', 'invoice_id')]
     }
 
 class Refund(Document):
@@ -85,7 +102,8 @@ class Refund(Document):
     refund_amount = FloatField()
     cancel_flag = BooleanField()
     meta = {
-       'indexes': ['invoice_id', 'refund_date']
+        'allow_inheritance': False,
+        'indexes': [('invoice_id', 'refund_date'), ('refund_date', 'invoice_id')]
     }
 
 class TermExtension(Document):
@@ -98,5 +116,99 @@ class TermExtension(Document):
     service_start = DateTimeField()
     service_end = DateTimeField()
     meta = {
-        'indexes': ['invoice_id', 'grant_date']
+        'allow_inheritance': False,
+        'indexes': [('invoice_id', 'grant_date'), ('grant_date', 'invoice_id'),
+                    ('service_end', 'invoice_id')]
+    }
+
+
+class RecognitionJob(Document):
+    """
+    A revenue recognition run. The invoice keyspace is split into chunks that
+    are checkpointed individually, so that a failed run can be resumed.
+    """
+    job_id = StringField()
+    obs_date = DateTimeField()
+    created = DateTimeField()
+    completed = DateTimeField()
+    status = StringField()
+    meta = {
+        'allow_inheritance': False,
+        'indexes': ['job_id']
+    }
+
+class JobChunk(Document):
+    """
+    A chunk of a recognition job, covering invoice ids in [lower, upper). An
+    open bound is stored as None. Once done, run_token identifies the monthly
+    entries that were committed for the chunk.
+    """
+    job_id = StringField()
+    chunk_no = IntField()
+    lower = StringField()
+    upper = StringField()
+    status = StringField()
+    run_token = StringField()
+    completed = DateTimeField()
+    meta = {
+        'allow_inheritance': False,
+        'indexes': [('job_id', 'chunk_no')]
+    }
+
+class LedgerRun(Document):
+    """
+    A run that replaces the monthly entries in its scope: invoice ids in
+    [lower, upper) or in invoice_ids, in the periods from first to last. Open
+    bounds are stored as None. While pending, the run's own entries are hidden
+    from readers. Once committed, the entries it replaces are hidden until they
+    are removed and the run is done.
+    """
+    run_token = StringField()
+    job_id = StringField()
+    status = StringField()
+    started = DateTimeField()
+    lower = StringField()
+    upper = StringField()
+    invoice_ids = ListField(StringField())
+    first_year = IntField()
+    first_month = IntField()
+    last_year = IntField()
+    last_month = IntField()
+    meta = {
+        'allow_inheritance': False,
+        'indexes': ['run_token', 'status', 'started']
+    }
+
+class PeriodClose(Document):
+    """
+    A closed reporting period. Monthly entries up to and including this month
+    are final and are not recomputed by later runs.
+    """
+    year = IntField()
+    month = IntField()
+    closed_at = DateTimeField()
+    meta = {
+        'allow_inheritance': False,
+        'indexes': [('year', 'month')]
     }
+
+class ItemSnapshot(Document):
+    """
+    The state of an invoice item as of the end of the latest closed period.
+    Reserves are running totals of the debits against them, contra_rev and
+    ref_payable those of dr_contra_rev and cr_ref_payable.
+    """
+    invoice_item_id = StringField()
+    invoice_id = StringField()
+    year = IntField()
+    month = IntField()
+    ending_defrev = FloatField()
+    cumul_rev = FloatField()
+    reserve_graceperiod = FloatField()
+    reserve_ref = FloatField()
+    contra_rev = FloatField()
+    ref_payable = FloatField()
+    meta = {
+        'allow_inheritance': False,
+        'indexes': ['invoice_item_id', 'invoice_id']
+    }
\ No newline at end of file
@@ -0,0 +1,247 @@
+import uuid
+from datetime import datetime, timedelta
+from itertools import groupby
+from helpers import chunked, last_day_of_month, RevrecError
+from models import (PeriodClose, ItemSnapshot, Invoice, InvoiceItem, Payment, Refund, TermExtension,
+                    RecognitionJob)
+from ledger import (iter_entries, stage_entries, swap_partitions, drop_partitions, recover_runs, record_run,
+                    unfinished_runs)
+from recognition import recognize_revenue, iter_monthly_entries, CURSOR_BATCH_SIZE, MAX_IN_FLIGHT
+
+"""
+-------------------
+PERIOD CLOSE
+-------------------
+"""
+def latest_close():
+    """
+    :return PeriodClose. The most recently closed period, or None if no period is closed.
+    """
+    return PeriodClose.objects.order_by('-year', '-month').first()
+
+def close_date_of(close):
+    """
+    :param close: PeriodClose object.
+    :return datetime. The last day of the closed period.
+    """
+    return datetime(close.year, close.month, last_day_of_month(close.year, close.month))
+
+def close_period(year, month):
+    """Closes a reporting period and freezes the state of every invoice item at its end.
+
+    Snapshots are rolled forward from the previous close, so only the ledger partitions of
+    the months since then are read: ending deferred revenue is taken from the item's last
+    entry and revenue and reserves are accumulated. A period cannot be closed while a
+    recognition job or a ledger run is unfinished, as it would later rewrite the period.
+
+    :param year: Year of the period to close.
+    :param month: Month of the period to close.
+    :return PeriodClose.
+    """
+    prev = latest_close()
+    if prev is not None and (prev.year, prev.month) >= (year, month):
+        raise RevrecError('Period %s-%02d is already closed.' % (year, month))
+    job = RecognitionJob.objects(status='running').first()
+    if job is not None:
+        raise RevrecError('Job %s is unfinished, resume it before closing a period.' % job.job_id)
+    runs = unfinished_runs()
+    if runs:
+        raise RevrecError('Ledger run %s is unfinished, rerun recognition before closing a period.'
+                          % runs[0].run_token)
+
+    fields = dict((f, True) for f in ['invoice_item_id', 'invoice_id', 'ending_defrev', 'cr_rev',
+                                      'dr_reserve_graceperiod', 'dr_reserve_ref', 'dr_contra_rev',
+                                      'cr_ref_payable'])
+    first = period_after(prev.year, prev.month) if prev is not None else None
+    entries = iter_entries(fields=fields, first=first, last=(year, month))
+
+    items = ((item_id, list(rows)) for item_id, rows in groupby(entries, lambda d: d['invoice_item_id']))
+    count = 0
+    try:
+        for group in chunked(items, CURSOR_BATCH_SIZE):
+            snapshots = dict((s.invoice_item_id, s) for s in
+                             ItemSnapshot.objects(invoice_item_id__in=[item_id for item_id, rows in group]))
+            for item_id, rows in group:
+                save_snapshot(snapshots.get(item_id), item_id, rows, year, month)
+            count += len(group)
+    finally:
+        entries.close()
+
+    close = PeriodClose(year=year, month=month, closed_at=datetime.now())
+    close.save()
+    print 'Closed %s-%02d, %s item snapshots rolled forward.' % (year, month, count)
+    return close
+
+def save_snapshot(prev, item_id, rows, year, month):
+    """Rolls an item snapshot forward over the monthly entries since the previous close
+    and replaces the stored snapshot.
+
+    :param prev: ItemSnapshot of the item at the previous close, or None.
+    :param item_id: Invoice item id.
+    :param rows: Monthly entry documents of the item since the previous close, in order.
+    :param year: Year of the period being closed.
+    :param month: Month of the period being closed.
+    """
+    snapshot = ItemSnapshot(invoice_item_id=item_id,
+                            invoice_id=rows[-1].get('invoice_id'),
+                            year=year,
+                            month=month,
+                            ending_defrev=rows[-1]['ending_defrev'],
+                            cumul_rev=prev.cumul_rev if prev else 0,
+                            reserve_graceperiod=prev.reserve_graceperiod if prev else 0,
+                            reserve_ref=prev.reserve_ref if prev else 0,
+                            contra_rev=(prev.contra_rev or 0) if prev else 0,
+                            ref_payable=(prev.ref_payable or 0) if prev else 0)
+    for row in rows:
+        snapshot.cumul_rev += row['cr_rev']
+        snapshot.reserve_graceperiod += row['dr_reserve_graceperiod']
+        snapshot.reserve_ref += row['dr_reserve_ref']
+        snapshot.contra_rev += row['dr_contra_rev']
+        snapshot.ref_payable += row['cr_ref_payable']
+
+    ItemSnapshot._get_collection().update({'invoice_item_id': item_id}, snapshot.to_mongo(), upsert=True)
+
+def period_after(year, month):
+    """
+    :return tuple. (year, month) of the period following the specified one.
+    """
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+def archive_periods(year, month):
+    """Drops the ledger partitions of every period up to and including the specified
+    one. The periods must be closed, so that their item snapshots carry the state that
+    later runs continue from.
+
+    :param year: Year of the last period to archive.
+    :param month: Month of the last period to archive.
+    :return list. (year, month) of the dropped partitions.
+    """
+    close = latest_close()
+    if close is None or (close.year, close.month) < (year, month):
+        raise RevrecError('Period %s-%02d is not closed.' % (year, month))
+
+    dropped = drop_partitions(last=(year, month))
+    print 'Archived %s periods through %s-%02d.' % (len(dropped), year, month)
+    return dropped
+
+"""
+-------------------
+OPEN PERIODS
+-------------------
+"""
+def recognize_open_periods(obs_date=datetime(2014,1,1), max_in_flight=MAX_IN_FLIGHT):
+    """Performs revenue recognition on the open periods only. Invoices without any
+    activity after the latest close are not read, items with a snapshot continue from
+    it, and the monthly entries of closed periods are left untouched. Without a
+    closed period, this is a full recognize_revenue run.
+
+    The open periods are rebuilt in staging collections and swapped in, see
+    rebuild_periods.
+
+    :param obs_date: Reporting date.
+    :param max_in_flight: Maximum number of invoices whose entries are held in memory.
+    :return int. Number of monthly entries written.
+    """
+    close = latest_close()
+    if close is None:
+        return recognize_revenue(obs_date=obs_date, max_in_flight=max_in_flight)
+
+    open_start = close_date_of(close) + timedelta(1)
+    invoice_ids = open_invoice_ids(close_date_of(close), obs_date)
+    print '%s invoices with open activity after %s-%02d.' % (len(invoice_ids), close.year, close.month)
+
+    written = rebuild_periods(invoice_ids, (open_start.year, open_start.month), obs_date=obs_date,
+                              max_in_flight=max_in_flight, open_start=open_start)
+    print '%s monthly entries written.' % written
+    return written
+
+def rerun_period(year, month, obs_date=datetime(2014,1,1), max_in_flight=MAX_IN_FLIGHT):
+    """Recomputes the monthly entries of a single open period and replaces its ledger
+    partition at once, see rebuild_periods. Only invoices with activity since the start
+    of the period are read. Other periods are not touched.
+
+    Items with a snapshot continue from it, as in recognize_open_periods.
+
+    :param year: Year of the period.
+    :param month: Month of the period.
+    :param obs_date: Reporting date.
+    :param max_in_flight: Maximum number of invoices whose entries are held in memory.
+    :return int. Number of monthly entries written.
+    """
+    close = latest_close()
+    open_start = None
+    if close is not None:
+        if (close.year, close.month) >= (year, month):
+            raise RevrecError('Period %s-%02d is closed.' % (year, month))
+        open_start = close_date_of(close) + timedelta(1)
+
+    invoice_ids = open_invoice_ids(datetime(year, month, 1) - timedelta(1), obs_date)
+    written = rebuild_periods(invoice_ids, (year, month), (year, month), obs_date=obs_date,
+                              max_in_flight=max_in_flight, open_start=open_start)
+    print 'Period %s-%02d replaced, %s monthly entries written.' % (year, month, written)
+    return written
+
+def rebuild_periods(invoice_ids, first, last=None, obs_date=datetime(2014,1,1),
+                    max_in_flight=MAX_IN_FLIGHT, open_start=None):
+    """Recomputes the monthly entries of the periods from first to last in a single pass
+    over the invoices. The entries are written to one staging collection per period,
+    and each staging collection then replaces its period's ledger partition in a single
+    rename. Readers see either the old or the new entries of a period, never a mix, and
+    nothing is removed entry by entry. Partitions in the range that receive no entries
+    are dropped.
+
+    The invoices must include every invoice with entries in the range, see
+    open_invoice_ids. Failed ledger runs are settled first and the rebuild is recorded
+    as a ledger run, so that it supersedes unfinished recognition jobs.
+
+    :param invoice_ids: Invoice ids to recompute.
+    :param first: (year, month) of the first period.
+    :param last: (year, month) of the last period, or None if unbounded.
+    :param obs_date: Reporting date.
+    :param max_in_flight: Maximum number of invoices whose entries are held in memory.
+    :param open_start: First day after the latest close. Items with a snapshot continue
+                       from it. None if no period is closed.
+    :return int. Number of monthly entries written.
+    """
+    recover_runs()
+    run_token = uuid.uuid4().hex
+    staging = {}
+
+    written = 0
+    for group in chunked(sorted(invoice_ids), max_in_flight):
+        snapshots = None
+        if open_start is not None:
+            snapshots = dict((s.invoice_item_id, s) for s in ItemSnapshot.objects(invoice_id__in=group))
+        invoices = Invoice.objects(invoice_id__in=group, invoice_date__lte=obs_date)
+        entries = iter_monthly_entries(invoices, obs_date=obs_date, run_token=run_token,
+                                       snapshots=snapshots, open_start=open_start)
+        docs = [entry.to_mongo() for entry in entries
+                if (entry.year, entry.month) >= first and (last is None or (entry.year, entry.month) <= last)]
+        written += stage_entries(docs, staging)
+
+    swap_partitions(staging, first, last)
+    record_run(run_token, first=first, last=last)
+    return written
+
+def open_invoice_ids(close_date, obs_date=datetime(2014,1,1)):
+    """Returns the ids of invoices with activity after the close date: items still in
+    service or extended past it, and invoices, payments, refunds and term extensions
+    dated after it.
+
+    :param close_date: Last day of the latest closed period.
+    :param obs_date: Reporting date.
+    :return set. Invoice ids.
+    """
+    after_close = {'$gt': close_date, '$lte': obs_date}
+    queries = [(InvoiceItem, {'service_end': {'$gt': close_date}}),
+               (Invoice, {'invoice_date': after_close}),
+               (Payment, {'payment_date': after_close}),
+               (Refund, {'refund_date': after_close}),
+               (TermExtension, {'grant_date': after_close}),
+               (TermExtension, {'service_end': {'$gt': close_date}})]
+
+    invoice_ids = set()
+    for document, query in queries:
+        cursor = document._get_collection().find(query, fields={'invoice_id': True, '_id': False})
+        invoice_ids.update(doc['invoice_id'] for doc in cursor)
+    return invoice_ids
@@ -0,0 +1,212 @@
+import sys
+import time
+import threading
+import Queue
+from collections import deque
+from datetime import datetime
+from ledger import begin_run, commit_run, finish_run
+from recognition import (iter_invoices, load_invoice_events, invoice_entries, insert_monthly_docs,
+                    CURSOR_BATCH_SIZE)
+
+QUEUE_SIZE = 100
+WRITE_BATCH = 1000
+
+# Marks the end of a stage's output
+_DONE = object()
+
+"""
+-------------------
+PIPELINE
+-------------------
+"""
+def run_pipeline(source, compute, sink, queue_size=QUEUE_SIZE, write_batch=WRITE_BATCH, pool=None):
+    """Runs a fetch / compute / write pipeline with one thread per stage. Stages are
+    connected by bounded queues, so a slow stage blocks the stages that feed it instead
+    of letting work pile up in memory, and throughput approaches that of the slowest stage.
+
+    The stages only see the callables passed in, so the pipeline can run against a
+    local mongod as well as against in-memory lists.
+
+    :param source: Iterable of work units. Iterated in the fetch stage.
+    :param compute: Function that maps a work unit to a list of outputs.
+    :param sink: Function that writes a list of outputs and returns the number written.
+    :param queue_size: Capacity of each queue between stages, and the number of work units
+                       in flight in the pool.
+    :param write_batch: Minimum number of outputs per call to sink, except for the last.
+    :param pool: Optional multiprocessing Pool or ThreadPool to run compute in. With a
+                 process pool, work units and outputs must be picklable.
+    :return dict. 'written' is the number of outputs written, 'fetch', 'compute' and
+                  'write' the seconds each stage spent working, excluding queue waits.
+    """
+    fetched = Queue.Queue(queue_size)
+    computed = Queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+    stats = {'written': 0, 'fetch': 0.0, 'compute': 0.0, 'write': 0.0}
+
+    def put(queue, element):
+        # Blocks while the queue is full, unless another stage failed
+        while not stop.is_set():
+            try:
+                queue.put(element, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get(queue):
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        return _DONE
+
+    def fetch_stage():
+        units = iter(source)
+        while True:
+            started = time.time()
+            try:
+                unit = next(units)
+            except StopIteration:
+                break
+            finally:
+                stats['fetch'] += time.time() - started
+            if not put(fetched, unit):
+                return
+        put(fetched, _DONE)
+
+    def compute_stage():
+        pending = deque()
+        while True:
+            unit = get(fetched)
+            if unit is _DONE:
+                break
+            started = time.time()
+            if pool is None:
+                outputs = compute(unit)
+            else:
+                pending.append(pool.apply_async(compute, (unit,)))
+                outputs = pending.popleft().get() if len(pending) >= queue_size else None
+            stats['compute'] += time.time() - started
+            if outputs is not None and not put(computed, outputs):
+                return
+        while pending:
+            if not put(computed, pending.popleft().get()):
+                return
+        put(computed, _DONE)
+
+    def write_stage():
+        batch = []
+        while True:
+            outputs = get(computed)
+            if outputs is _DONE:
+                break
+            batch.extend(outputs)
+            if len(batch) >= write_batch:
+                write(batch)
+                batch = []
+        if batch and not stop.is_set():
+            write(batch)
+
+    def write(batch):
+        started = time.time()
+        stats['written'] += sink(batch)
+        stats['write'] += time.time() - started
+
+    def guarded(stage):
+        def run():
+            try:
+                stage()
+            except Exception:
+                errors.append(sys.exc_info())
+                stop.set()
+        return run
+
+    threads = [threading.Thread(target=guarded(stage))
+               for stage in (fetch_stage, compute_stage, write_stage)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Joining with a timeout keeps the main thread responsive to Ctrl-C. On an interrupt,
+    # the stages are stopped and joined, so no write is left running behind the caller.
+    try:
+        join_all(threads)
+    except KeyboardInterrupt:
+        stop.set()
+        join_all(threads)
+        raise
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return stats
+
+def join_all(threads, timeout=0.1):
+    """Waits for threads to end, waking up every timeout seconds so that signals, e.g.
+    KeyboardInterrupt, are handled in the meantime.
+
+    :param threads: List of started threads.
+    :param timeout: Seconds between checks.
+    """
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(timeout)
+
+"""
+-------------------
+REVENUE RECOGNITION
+-------------------
+"""
+def recognize_revenue_pipelined(obs_date=datetime(2014,1,1), batch_size=CURSOR_BATCH_SIZE,
+                                queue_size=QUEUE_SIZE, write_batch=WRITE_BATCH, pool=None):
+    """Performs revenue recognition like recognition.recognize_revenue, with the db reads of
+    upcoming invoices, the schedule computations and the monthly entry writes overlapping.
+    As there, the run replaces the whole ledger as a single ledger run. Entries are
+    stamped with its token in the write stage.
+
+    :param obs_date: Reporting date.
+    :param batch_size: Number of invoices fetched per cursor round trip.
+    :param queue_size: Capacity of the queues between stages.
+    :param write_batch: Number of monthly entries per bulk insert.
+    :param pool: Optional multiprocessing Pool or ThreadPool to compute schedules in.
+    :return int. Number of monthly entries written.
+    """
+    run_token = begin_run()
+
+    def sink(docs):
+        for doc in docs:
+            doc['run_token'] = run_token
+        return insert_monthly_docs(docs)
+
+    stats = run_pipeline(source=iter_invoice_events(obs_date, batch_size),
+                         compute=compute_invoice,
+                         sink=sink,
+                         queue_size=queue_size,
+                         write_batch=write_batch,
+                         pool=pool)
+    commit_run(run_token)
+    finish_run(run_token)
+
+    print '%(written)s monthly entries written. Busy seconds: fetch %(fetch).1f, ' \
+          'compute %(compute).1f, write %(write).1f.' % stats
+    return stats['written']
+
+def iter_invoice_events(obs_date=datetime(2014,1,1), batch_size=CURSOR_BATCH_SIZE):
+    """A generator that yields each invoice along with its items and events.
+
+    :param obs_date: Reporting date.
+    :param batch_size: Number of invoices fetched per cursor round trip.
+    """
+    for invoice in iter_invoices(obs_date=obs_date, batch_size=batch_size):
+        yield invoice, load_invoice_events(invoice, obs_date=obs_date)
+
+def compute_invoice(unit):
+    """Computes the monthly entry documents of an invoice. Module level, so that it can
+    be sent to a process pool.
+
+    :param unit: Tuple of an Invoice object and its events, see load_invoice_events.
+    :return list. Monthly entry documents, as produced by MonthlyEntry.to_mongo.
+    """
+    invoice, events = unit
+    return [entry.to_mongo() for entry in invoice_entries(invoice, events)]
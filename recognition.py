@@ -0,0 +1,327 @@
+from __future__ import division
+from datetime import datetime
+from helpers import chunked
+from mongoengine import connect
+from models import Invoice, InvoiceItem, Payment, Refund, TermExtension, MonthlyEntry
+from use_cases import schedule_invoice, from_units
+from ledger import (insert_entries, partitions, partition_name, begin_run, commit_run, finish_run,
+                    unfinished_runs, visible_query)
+import pprint
+
+DB_NAME = 'revrec'
+GRACE_PERIOD = 16
+CURSOR_BATCH_SIZE = 500
+MAX_IN_FLIGHT = 100
+
+# If set, schedules are computed in fixed-point units of 1/LEDGER_SCALE (e.g. 100 for
+# cents) and monthly entries are exact sums of those units. None keeps float schedules.
+LEDGER_SCALE = None
+
+# If set to a schedule_cache.ScheduleCache, item schedules with identical inputs are
+# computed once and reused across items and, with an on-disk tier, across runs.
+SCHEDULE_CACHE = None
+invoices = {}
+
+"""
+-------------------
+REVENUE RECOGNITION
+-------------------
+"""
+def recognize_revenue(obs_date=datetime(2014,1,1), batch_size=CURSOR_BATCH_SIZE,
+                      max_in_flight=MAX_IN_FLIGHT):
+    """Streams invoices in the MongoDB invoice collection through revenue
+    recognition and persists the monthly rollups in the db.
+
+    The run is a generator pipeline: a server-side cursor feeds invoices one at
+    a time, each invoice is turned into monthly entries item by item, and the
+    entries are bulk inserted per group of at most `max_in_flight` invoices.
+    Nothing else is retained between groups, so memory stays flat regardless of
+    the number of invoices.
+
+    The run replaces the whole ledger as a single ledger run: its entries become
+    visible to readers at once when it commits, and earlier entries are removed
+    afterwards, see ledger.begin_run.
+
+    :param obs_date: Reporting date. Events that occur after this date should
+                     be excluded from the revenue recognition process.
+    :param batch_size: Number of invoices fetched per cursor round trip.
+    :param max_in_flight: Maximum number of invoices whose entries are held in
+                          memory before being written.
+    :return int. Number of monthly entries written.
+    """
+    run_token = begin_run()
+    invoices = iter_invoices(obs_date=obs_date, batch_size=batch_size)
+
+    written = 0
+    for group in chunked(invoices, max_in_flight):
+        written += write_monthly_entries(iter_monthly_entries(group, obs_date=obs_date,
+                                                              run_token=run_token))
+    commit_run(run_token)
+    finish_run(run_token)
+
+    print '%s monthly entries written.' % written
+    return written
+
+def iter_invoices(obs_date=datetime(2014,1,1), batch_size=CURSOR_BATCH_SIZE, lower=None, upper=None):
+    """A generator over invoices dated on or before the reporting date, read
+    through a server-side cursor. The cursor is opened without the idle timeout
+    so that a long close does not lose it mid-run, and is always closed once
+    the generator is exhausted or discarded.
+
+    :param obs_date: Reporting date.
+    :param batch_size: Number of invoices fetched per cursor round trip.
+    :param lower: If set, only invoices with invoice_id >= lower are returned.
+    :param upper: If set, only invoices with invoice_id < upper are returned.
+    """
+    query = {'invoice_date': {'$lte': obs_date}}
+    invoice_id_range = invoice_id_query(lower, upper)
+    if invoice_id_range:
+        query['invoice_id'] = invoice_id_range
+
+    cursor = Invoice._get_collection().find(query, timeout=False)
+    cursor.batch_size(batch_size)
+    try:
+        for son in cursor:
+            yield Invoice._from_son(son)
+    finally:
+        cursor.close()
+
+def invoice_id_query(lower=None, upper=None):
+    """Returns the Mongo query condition for invoice ids in [lower, upper).
+
+    :param lower: Inclusive lower bound, or None if unbounded.
+    :param upper: Exclusive upper bound, or None if unbounded.
+    :return dict. Empty if both bounds are open.
+    """
+    condition = {}
+    if lower is not None:
+        condition['$gte'] = lower
+    if upper is not None:
+        condition['$lt'] = upper
+    return condition
+
+def iter_monthly_entries(invoices, obs_date=datetime(2014,1,1), run_token=None, snapshots=None,
+                         open_start=None):
+    """A generator that yields unsaved MonthlyEntry objects for each paid
+    invoice in turn. Schedules are dropped as soon as their entries are yielded.
+
+    :param invoices: Iterable of Invoice objects.
+    :param obs_date: Reporting date.
+    :param run_token: Token stamped on the entries to identify the run that wrote them.
+    :param snapshots: If set, dictionary of closed-period snapshots keyed on item id. Items
+                      are then only scheduled from :param open_start on.
+    :param open_start: First day of the open periods.
+    """
+    for invoice in invoices:
+        events = load_invoice_events(invoice, obs_date=obs_date)
+        for entry in invoice_entries(invoice, events, run_token=run_token, snapshots=snapshots,
+                                     open_start=open_start):
+            yield entry
+
+def invoice_entries(invoice, events, run_token=None, snapshots=None, open_start=None):
+    """A generator that yields unsaved MonthlyEntry objects for an invoice, if it is paid.
+    Does not access the db. Schedules are computed with the LEDGER_SCALE and
+    SCHEDULE_CACHE settings in effect at the time of the call.
+
+    :param invoice: Invoice object.
+    :param events: Invoice items and events of the invoice, see load_invoice_events.
+    :param run_token: Token stamped on the entries to identify the run that wrote them.
+    :param snapshots: If set, dictionary of closed-period snapshots keyed on item id.
+    :param open_start: First day of the open periods.
+    """
+    payment = events['payment']
+    if payment is None or not invoice.is_paid(payment):
+        return
+
+    item_snapshots = None
+    if open_start is not None:
+        item_snapshots = [snapshots.get(item.item_id) for item in events['invoice_items']]
+
+    results = schedule_invoice(invoice_amount=invoice.invoice_amount,
+                               items=events['invoice_items'],
+                               payment_date=payment.payment_date,
+                               refunds=events['refunds'],
+                               term_extensions=events['term_extensions'],
+                               scale=LEDGER_SCALE,
+                               snapshots=item_snapshots,
+                               open_start=open_start,
+                               cache=SCHEDULE_CACHE)
+    for entry in invoice_monthly_entries(invoice, results, run_token=run_token, scale=LEDGER_SCALE):
+        yield entry
+
+def process_invoice(invoice, return_dict=False, obs_date=datetime(2014,1,1)):
+    """For a specified invoice, creates the daily revenue recognition schedules
+    of all invoice items and persists them as monthly rollups into MongoDB.
+
+    :param invoice: Invoice object.
+    :param return_dict: True if returns dictionary for template use.
+    :param obs_date: Reporting date. Events that occur after this date should
+                     be excluded from the revenue recognition process.
+    :return dict. If :param return_dict is True, returns dictionary for template use.
+    """
+    # Retrieve objects relevant to this invoice
+    events = load_invoice_events(invoice, obs_date=obs_date)
+    invoice_items = events['invoice_items']
+    payment = events['payment']
+    refunds = events['refunds']
+    term_extensions = events['term_extensions']
+
+    print 'Counts: invitems: %s, pmt: %s, refs: %s, termexts: %s' % (len(invoice_items),
+                                                                     payment,
+                                                                     len(refunds),
+                                                                     len(term_extensions))
+
+    results = {'items': [], 'revrec_schedule': {}, 'monthly_schedule': {}}
+
+    # If invoice is paid, create the revenue recognition schedules of all items
+    if payment is not None and invoice.is_paid(payment):
+        results = schedule_invoice(invoice_amount=invoice.invoice_amount,
+                                   items=invoice_items,
+                                   payment_date=payment.payment_date,
+                                   refunds=refunds,
+                                   term_extensions=term_extensions,
+                                   daily_total=True)
+
+        # Save monthly schedules to the ledger partitions
+        write_monthly_entries(invoice_monthly_entries(invoice, results))
+
+    # Return dictionary
+    if return_dict:
+        return {
+            'revrec_schedule': results['revrec_schedule'],
+            'item_schedules': results['items'],
+            'invoice_items': invoice_items,
+            'payment': payment,
+            'refunds': refunds,
+            'term_extensions': term_extensions,
+            'gp_notes': [note for r in results['items'] for note in r['gp_notes']]
+        }
+
+def load_invoice_events(invoice, obs_date=datetime(2014,1,1)):
+    """Retrieves the invoice items and the payment, refund and term extension
+    events of an invoice up to the reporting date. Event lists are materialized
+    once so that they are not re-queried for every invoice item. Each query
+    matches a compound (invoice_id, date) index.
+
+    :param invoice: Invoice object.
+    :param obs_date: Reporting date.
+    :return dict. Keyed on 'invoice_items', 'payment', 'refunds', 'term_extensions'.
+    """
+    return {
+        'invoice_items': list(InvoiceItem.objects(invoice_id=invoice.invoice_id)),
+        'payment': Payment.objects(invoice_id=invoice.invoice_id, payment_date__lte=obs_date).first(),
+        'refunds': list(Refund.objects(invoice_id=invoice.invoice_id, refund_date__lte=obs_date)),
+        'term_extensions': list(TermExtension.objects(invoice_id=invoice.invoice_id,
+                                                      grant_date__lte=obs_date))
+    }
+
+def invoice_monthly_entries(invoice, results, run_token=None, scale=None):
+    """A generator that yields unsaved MonthlyEntry objects for every item of an invoice.
+
+    :param invoice: Invoice object.
+    :param results: Invoice schedules, see use_cases.schedule_invoice.
+    :param run_token: Token stamped on the entries to identify the run that wrote them.
+    :param scale: Fixed-point scale of the schedules, or None for float schedules.
+    """
+    for item_results in results['items']:
+        for entry in monthly_entries(invoice, item_results['item'], item_results['monthly_schedule'],
+                                     run_token=run_token, scale=scale):
+            yield entry
+
+def monthly_entries(invoice, item, monthly_schedule, run_token=None, scale=None):
+    """A generator that yields unsaved MonthlyEntry objects for a monthly schedule.
+
+    :param invoice: Invoice object.
+    :param item: InvoiceItem object.
+    :param monthly_schedule: Dictionary of debits and credits by month, see rollup_month.
+    :param run_token: Token stamped on the entries to identify the run that wrote them.
+    :param scale: If set, the monthly schedule is in fixed-point units of 1/scale.
+    """
+    for month, values in monthly_schedule.iteritems():
+        yearmonth = month.split('-')
+        if scale is not None:
+            values = dict((k, from_units(v, scale)) for k, v in values.iteritems())
+        yield MonthlyEntry(account_id=invoice.account_id,
+                           invoice_id=invoice.invoice_id,
+                           invoice_item_id=item.item_id,
+                           run_token=run_token,
+                           month=int(yearmonth[1]),
+                           year=int(yearmonth[0]),
+                           cr_rev=values['cr_rev'],
+                           ending_defrev=values['ending_defrev'],
+                           cr_ref_payable=values['cr_ref_payable'],
+                           dr_reserve_ref=values['dr_reserve_ref'],
+                           dr_contra_rev=values['dr_contra_rev'],
+                           dr_defrev=values['dr_defrev'],
+                           dr_reserve_graceperiod=values['dr_reserve_graceperiod'],
+                           cr_contra_rev=values['cr_contra_rev'])
+
+def write_monthly_entries(entries):
+    """Persists MonthlyEntry objects with a single bulk insert.
+
+    :param entries: Iterable of unsaved MonthlyEntry objects.
+    :return int. Number of entries written.
+    """
+    return insert_monthly_docs([entry.to_mongo() for entry in entries])
+
+def insert_monthly_docs(docs):
+    """Bulk inserts monthly entry documents, as produced by MonthlyEntry.to_mongo, into
+    the ledger partitions of their periods.
+
+    :param docs: List of documents.
+    :return int. Number of documents written.
+    """
+    return insert_entries(docs)
+
+"""
+--------------------
+MONGODB OPERATIONS
+--------------------
+"""
+def connect_db():
+    """Connect to Mongo database. The connection is shared by the mongoengine documents
+    and the returned pymongo db object. Nothing connects at import time, so call this
+    before any db access.
+
+    Currently set for localhost.
+    """
+    connection = connect(DB_NAME)
+    return connection[DB_NAME]
+
+def mapreduce(db):
+    """Mongo map reduce query to compute totals, run on each ledger partition.
+    Entries hidden by unfinished runs are left out, see ledger.visible_query.
+
+    :param db: Pymongo db object.
+    """
+    runs = unfinished_runs()
+    results = []
+    for year, month in partitions():
+        collection = db[partition_name(year, month)]
+        results.extend(collection.group(key={'year':True, 'month':True},
+                                        condition=visible_query(None, year, month, runs),
+                                        initial= {
+                                            'cr_rev': 0, 
+                                            'ending_defrev': 0, 
+                                            'cr_ref_payable': 0,
+                                            'dr_reserve_ref': 0,
+                                            'dr_contra_rev': 0,
+                                            'dr_defrev': 0,
+                                            'dr_reserve_graceperiod': 0,
+                                            'cr_contra_rev': 0
+                                        },
+                                        reduce= 'function(doc,out){ \
+                                            out.cr_rev+=doc.cr_rev; \
+                                            out.ending_defrev+=doc.ending_defrev; \
+                                            out.cr_ref_payable+=doc.cr_ref_payable; \
+                                            out.dr_reserve_ref+=doc.dr_reserve_ref; \
+                                            out.dr_contra_rev+=doc.dr_contra_rev; \
+                                            out.dr_defrev+=doc.dr_defrev; \
+                                            out.dr_reserve_graceperiod+=doc.dr_reserve_graceperiod; \
+                                            out.cr_contra_rev+=doc.cr_contra_rev; \
+                                            }',
+                                        finalize=''))
+
+    print 'Total revenue = $%s' % sum(r['cr_rev'] for r in results)
+    print 'Mapreduce results = '
+    pprint.pprint(results)
\ No newline at end of file
@@ -1,211 +1,308 @@
-from __future__ import division
-from calendar import monthrange
-from datetime import datetime, timedelta, date
-from helpers import pretty_date, last_day_of_month
-from seed import seed_db
-from mongoengine import connect
-from models import *
-from use_cases import *
-import pprint
-import pymongo
-
-GRACE_PERIOD = 16
-invoices = {}
+import argparse
+from datetime import datetime
 
 """
 -------------------
-REVENUE RECOGNITION
+SUBCOMMANDS
 -------------------
 """
-def recognize_revenue(obs_date=datetime(2014,1,1)):
-    """Cycles through invoices in the MongoDB invoice collection and performs
-    revenue recognition on each in turn. Results will be persisted in the db.
-
-    :param obs_date: Reporting date. Events that occur after this date should
-                     be excluded from the revenue recognition process.
-    """
-
-    invoices = Invoice.objects(invoice_date__lte=obs_date)
-    print '%s invoices found.' % len(invoices)
-
-    for invoice in invoices:
-        process_invoice(invoice, obs_date)
-
-def process_invoice(invoice, return_dict=False, obs_date=datetime(2014,1,1)):
-    """For a specified invoice, loops through the invoice items and creates
-    a daily revenue recognition schedule for each in turn and persists the
-    schedule as a monthly rollup into MongoDB.
-
-    :param invoice: Invoice object.
-    :param return_dict: True if returns dictionary for template use.
-    :param obs_date: Reporting date. Events that occur after this date should
-                     be excluded from the revenue recognition process.
-    :return dict. If :param return_dict is True, returns dictionary for template use.
-    """
-    # Retrieve objects relevant to this invoice
-    invoice_items = InvoiceItem.objects(invoice_id=invoice.invoice_id)
-    payment = Payment.objects(invoice_id=invoice.invoice_id, payment_date__lte=obs_date).first()
-    refunds = Refund.objects(invoice_id=invoice.invoice_id, refund_date__lte=obs_date)
-    term_extensions = TermExtension.objects(invoice_id=invoice.invoice_id, grant_date__lte=obs_date)
-
-    print 'Counts: invitems: %s, pmt: %s, refs: %s, termexts: %s' % (len(invoice_items),
-                                                                     payment,
-                                                                     len(refunds),
-                                                                     len(term_extensions))
-
-    # If invoice is paid, create the revenue recognition schedule
-    if invoice.is_paid():
-
-        # Recognize revenue on each invoice item
-        for item in invoice_items:
-
-            # Generate base amortization schedule based on amount, service term, payment date.
-            revrec_schedule = amortize_service_fee(item=item, payment_date=payment.payment_date)
-
-            # Adjust the schedule in the case of a late payment, i.e. when the grace period is used.
-            gp_notes = apply_grace_period(revrec_schedule=revrec_schedule,
-                                          item=item,
-                                          payment_date=payment.payment_date)
-
-            # Adjust the schedule for term extensions
-            apply_term_extensions(revrec_schedule=revrec_schedule, 
-                                  item=item, 
-                                  term_extensions=term_extensions)
-
-            # Adjust the schedule for refunds
-            apply_refunds(revrec_schedule=revrec_schedule, 
-                          invoice_amount=invoice.invoice_amount,
-                          item=item, 
-                          refunds=refunds)
-
-            # Roll up daily schedule to monthly schedule
-            monthly_schedule = rollup_month(revrec_schedule)
-
-            # Save monthly schedule to monthly_entry Mongo collection
-            for month, values in monthly_schedule.iteritems():
-                yearmonth = month.split('-')
-                m = MonthlyEntry(account_id=invoice.account_id,
-                                 invoice_item_id=item.item_id,
-                                 month=int(yearmonth[1]),
-                                 year=int(yearmonth[0]),
-                                 cr_rev=values['cr_rev'],
-                                 ending_defrev=values['ending_defrev'],
-                                 cr_ref_payable=values['cr_ref_payable'],
-                                 dr_reserve_ref=values['dr_reserve_ref'],
-                                 dr_contra_rev=values['dr_contra_rev'],
-                                 dr_defrev=values['dr_defrev'],
-                                 dr_reserve_graceperiod=values['dr_reserve_graceperiod'],
-                                 cr_contra_rev=values['cr_contra_rev'])
-                m.save()
-
-    # Return dictionary
-    if return_dict:
-        return {
-            'revrec_schedule': revrec_schedule,
-            'invoice_items': invoice_items,
-            'payment': payment,
-            'refunds': refunds,
-            'term_extensions': term_extensions,
-            'gp_notes': gp_notes
-        }
+# Each subcommand imports what it needs when it runs, so that --help, argument errors
+# and light subcommands do not pay for mongoengine, the models and the db connection.
 
-"""
---------------------
-DICTIONARY ROLLUPS
---------------------
-"""
-def rollup_month(revrec_schedule):
-    """Rolls up daily revenue schedule and returns a monthly schedule in dictionary form
-    keyed on month, i.e. '2012-01'.
-
-    :param revrec_schedule: Dictionary of debits and credits by day
-    :return dict. Dictionary of debits and credits by month
-    """
-    rollup = {}
-    dates = revrec_schedule.keys()
-    start_date = min(dates)
-    end_date = max(dates)
-    for date, value in revrec_schedule.iteritems():
-        key = '%s-%s' % (date.year, date.month)
-        try:
-            rollup[key]['cr_rev'] += value['cr_rev']
-            rollup[key]['cr_ref_payable'] += value['cr_ref_payable']
-            rollup[key]['dr_reserve_ref'] += value['dr_reserve_ref']
-            rollup[key]['dr_contra_rev'] += value['dr_contra_rev']
-            rollup[key]['dr_defrev'] += value['dr_defrev']
-            rollup[key]['dr_reserve_graceperiod'] += value['dr_reserve_graceperiod']
-            rollup[key]['cr_contra_rev'] += value['cr_contra_rev']
-        except KeyError:
-            rollup[key] = { 
-                'cr_rev': value['cr_rev'], 
-                'ending_defrev': 0,
-                'cr_ref_payable': value['cr_ref_payable'],
-                'dr_reserve_ref': value['dr_reserve_ref'],
-                'dr_contra_rev': value['dr_contra_rev'],
-                'dr_defrev': value['dr_defrev'],
-                'dr_reserve_graceperiod': value['dr_reserve_graceperiod'],
-                'cr_contra_rev': value['cr_contra_rev']
-            }
-        if date.day == monthrange(date.year, date.month)[1]:
-            rollup[key]['ending_defrev'] = value['ending_defrev']	
-    return rollup
+def recognize(args):
+    """Performs revenue recognition up to the reporting date and replaces the monthly entries.
+    """
+    from recognition import connect_db
+    from periods import latest_close
+    configure_recognition(args)
 
-"""
---------------------
-MONGODB OPERATIONS
---------------------
-"""
-def connect_db():
-    """Connect to Mongo database.
-
-    Currently set for localhost.
-    """
-    connection = pymongo.Connection('localhost', 27017)
-    db = connection['revrec']
-    return db
-
-def mapreduce(db):
-    """Mongo map reduce query to compute totals.
-
-    :param db: Pymongo db object.
-    """
-    revenue = MonthlyEntry.objects.sum('cr_rev')
-    print 'Total revenue = $%s' % revenue
-
-    results = db['monthly_entry'].group(key={'year':True, 'month':True},
-                                        condition={},
-                                        initial= {
-                                            'cr_rev': 0, 
-                                            'ending_defrev': 0, 
-                                            'cr_ref_payable': 0,
-                                            'dr_reserve_ref': 0,
-                                            'dr_contra_rev': 0,
-                                            'dr_defrev': 0,
-                                            'dr_reserve_graceperiod': 0,
-                                            'cr_contra_rev': 0
-                                        },
-                                        reduce= 'function(doc,out){ \
-                                            out.cr_rev+=doc.cr_rev; \
-                                            out.ending_defrev+=doc.ending_defrev; \
-                                            out.cr_ref_payable+=doc.cr_ref_payable; \
-                                            out.dr_reserve_ref+=doc.dr_reserve_ref; \
-                                            out.dr_contra_rev+=doc.dr_contra_rev; \
-                                            out.dr_defrev+=doc.dr_defrev; \
-                                            out.dr_reserve_graceperiod+=doc.dr_reserve_graceperiod; \
-                                            out.cr_contra_rev+=doc.cr_contra_rev; \
-                                            }',
-                                        finalize='')
-    print 'Mapreduce results = '
-    pprint.pprint(results)
+    if args.period:
+        from periods import rerun_period
+        connect_db()
+        return rerun_period(args.period[0], args.period[1], obs_date=args.obs_date)
+
+    # Once a period is closed, only the open periods are recomputed. Before that, the
+    # run is a resumable job, see the resume subcommand.
+    if not args.pipelined and not args.processes:
+        connect_db()
+        if latest_close() is not None:
+            from periods import recognize_open_periods
+            return recognize_open_periods(obs_date=args.obs_date)
+        from jobs import recognize_revenue_job
+        return recognize_revenue_job(obs_date=args.obs_date)
+
+    from helpers import RevrecError
+    from pipeline import recognize_revenue_pipelined
+
+    # Workers are forked after the imports above, so they start with the modules loaded,
+    # and before connecting, so they hold no db sockets. They compute schedules only.
+    pool = None
+    if args.processes:
+        from multiprocessing import Pool
+        pool = Pool(args.processes)
+
+    try:
+        connect_db()
+        close = latest_close()
+        if close is not None:
+            raise RevrecError('--pipelined recomputes every period, but periods through %s-%02d '
+                              'are closed.' % (close.year, close.month))
+        return recognize_revenue_pipelined(obs_date=args.obs_date, pool=pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def configure_recognition(args):
+    """Applies the recognition settings of the command line to the recognition module.
+    Called before the worker pool is forked, so that workers inherit them.
+    """
+    import recognition
+    recognition.LEDGER_SCALE = args.scale
+    recognition.SCHEDULE_CACHE = None
+    if args.cache_dir:
+        from schedule_cache import ScheduleCache, MAX_BYTES
+        recognition.SCHEDULE_CACHE = ScheduleCache(directory=args.cache_dir,
+                                                   max_bytes=args.cache_bytes or MAX_BYTES)
+
+def resume(args):
+    """Resumes a recognition job from its first unfinished chunk.
+    """
+    from recognition import connect_db
+    from helpers import RevrecError
+    from models import RecognitionJob
+    from jobs import recognize_revenue_job
+    configure_recognition(args)
+    connect_db()
+    if RecognitionJob.objects(job_id=args.job_id).first() is None:
+        raise RevrecError('There is no job %s.' % args.job_id)
+    recognize_revenue_job(job_id=args.job_id)
+
+def close(args):
+    """Closes a reporting period and snapshots every invoice item at its end.
+    """
+    from recognition import connect_db
+    from periods import close_period
+    connect_db()
+    close_period(*args.period)
+
+def seed(args):
+    """Replaces the contents of the db with fake data.
+    """
+    from recognition import connect_db
+    from seed import seed_db
+    seed_db(connect_db())
+
+def summarize(args):
+    """Prints total revenue and the monthly totals of the ledger.
+    """
+    from recognition import connect_db, mapreduce
+    mapreduce(connect_db())
+
+def export(args):
+    """Writes the ledger to a columnar export file, for integrity checks.
+    """
+    from recognition import connect_db
+    from integrity import export_ledger
+    connect_db()
+    export_ledger(args.path)
+
+def archive(args):
+    """Drops the ledger partitions of closed periods up to and including a period.
+    """
+    from recognition import connect_db
+    from periods import archive_periods
+    connect_db()
+    archive_periods(*args.through)
+
+def check(args):
+    """Checks the integrity of the ledger, or of an export file, and lists the violations.
+    """
+    import sys
+    from recognition import connect_db
+    from integrity import (load_ledger, load_export, load_item_terms, load_snapshots, check_ledger,
+                           print_violations)
+    connect_db()
+    columns = load_export(args.path) if args.path else load_ledger()
+    print 'Checking %s monthly entries...' % len(columns['year'])
+    violations = check_ledger(columns, load_item_terms(), snapshots=load_snapshots())
+    print_violations(violations)
+    sys.exit(1 if violations else 0)
+
+def explain(args):
+    """Explains the hot queries and lists those not covered by an index.
+    """
+    import sys
+    from recognition import connect_db
+    from explain import explain_hot_queries
+    connect_db()
+    problems = explain_hot_queries(obs_date=args.obs_date)
+    for problem in problems:
+        print problem
+    sys.exit(1 if problems else 0)
+
+def shadow(args):
+    """Compares a candidate schedule engine with the reference engine on a sample of invoices.
+    """
+    import sys
+    from recognition import connect_db
+    from helpers import RevrecError
+    from shadow import run_shadow, ENGINES, SAMPLE_RATE, REPORT_PATH
+    if args.candidate not in ENGINES:
+        raise RevrecError('There is no engine %s, choose from %s.' % (args.candidate,
+                                                                       ', '.join(sorted(ENGINES))))
+    connect_db()
+    summary = run_shadow(candidate=args.candidate, sample_rate=args.sample_rate or SAMPLE_RATE,
+                         obs_date=args.obs_date, report_path=args.report or REPORT_PATH)
+    sys.exit(1 if summary['mismatched'] else 0)
+
+def scenarios(args):
+    """Compares grace period and refund ordering policies with the current one.
+    """
+    from recognition import connect_db
+    from scenarios import (load_portfolio, simulate, monthly_deltas, print_deltas, policy_scenarios,
+                           GRACE_PERIODS)
+    connect_db()
+    portfolio = load_portfolio(obs_date=args.obs_date)
+    print '%s paid invoices loaded.' % len(portfolio)
+    print_deltas(monthly_deltas(simulate(portfolio, policy_scenarios(args.grace_periods or GRACE_PERIODS))))
+
+def split_legacy(args):
+    """Moves the entries of the unpartitioned monthly_entry collection into partitions.
+    """
+    from recognition import connect_db
+    from ledger import split_legacy_collection
+    connect_db()
+    print '%s monthly entries moved into partitions.' % split_legacy_collection()
 
 """
 -------------------------
 COMMAND LINE EXECUTABLE
 -------------------------
 """
+def parse_date(value):
+    """
+    :param value: Date as YYYY-MM-DD.
+    :return datetime.
+    """
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError('%r is not a date of the form YYYY-MM-DD' % value)
+
+def parse_period(value):
+    """
+    :param value: Period as YYYY-MM.
+    :return tuple. (year, month).
+    """
+    try:
+        period = datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        raise argparse.ArgumentTypeError('%r is not a period of the form YYYY-MM' % value)
+    return period.year, period.month
+
+def add_recognition_options(p):
+    """Adds the options of configure_recognition to a subcommand parser.
+    """
+    p.add_argument('--scale', type=int,
+                   help='compute schedules in fixed-point units of 1/SCALE, e.g. 100 for cents '
+                        '(default: floats)')
+    p.add_argument('--cache-dir',
+                   help='reuse item schedules with identical inputs, within the run and across '
+                        'runs through this directory')
+    p.add_argument('--cache-bytes', type=int,
+                   help='size of the cache directory above which the least recently used '
+                        'schedules are evicted (default: 1 GB)')
+
+def parser():
+    """
+    :return ArgumentParser. Parser of the revrec command line.
+    """
+    p = argparse.ArgumentParser(prog='revrec', description='Revenue recognition.')
+    subcommands = p.add_subparsers(title='subcommands')
+
+    p_recognize = subcommands.add_parser('recognize', help=recognize.__doc__.strip())
+    p_recognize.add_argument('--obs-date', type=parse_date, default=datetime(2014,1,1),
+                             help='reporting date, YYYY-MM-DD (default: 2014-01-01)')
+    p_recognize.add_argument('--pipelined', action='store_true',
+                             help='overlap db reads, schedule computations and writes')
+    p_recognize.add_argument('--processes', type=int, default=0,
+                             help='compute schedules in a pool of this many processes, implies '
+                                  '--pipelined')
+    p_recognize.add_argument('--period', type=parse_period,
+                             help='only replace the entries of this open period, YYYY-MM')
+    add_recognition_options(p_recognize)
+    p_recognize.set_defaults(func=recognize)
+
+    p_resume = subcommands.add_parser('resume', help=resume.__doc__.strip())
+    p_resume.add_argument('job_id', help='id of the job, as printed when it started')
+    add_recognition_options(p_resume)
+    p_resume.set_defaults(func=resume)
+
+    p_close = subcommands.add_parser('close', help=close.__doc__.strip())
+    p_close.add_argument('period', type=parse_period, help='period to close, YYYY-MM')
+    p_close.set_defaults(func=close)
+
+    p_seed = subcommands.add_parser('seed', help=seed.__doc__.strip())
+    p_seed.set_defaults(func=seed)
+
+    p_summarize = subcommands.add_parser('summarize', help=summarize.__doc__.strip())
+    p_summarize.set_defaults(func=summarize)
+
+    p_export = subcommands.add_parser('export', help=export.__doc__.strip())
+    p_export.add_argument('path', help='path of the export file')
+    p_export.set_defaults(func=export)
+
+    p_archive = subcommands.add_parser('archive', help=archive.__doc__.strip())
+    p_archive.add_argument('through', type=parse_period, help='last period to archive, YYYY-MM')
+    p_archive.set_defaults(func=archive)
+
+    p_check = subcommands.add_parser('check', help=check.__doc__.strip())
+    p_check.add_argument('path', nargs='?', help='path of an export file to check instead of the ledger')
+    p_check.set_defaults(func=check)
+
+    p_explain = subcommands.add_parser('explain', help=explain.__doc__.strip())
+    p_explain.add_argument('--obs-date', type=parse_date, default=datetime(2014,1,1),
+                           help='reporting date of the queries, YYYY-MM-DD (default: 2014-01-01)')
+    p_explain.set_defaults(func=explain)
+
+    p_shadow = subcommands.add_parser('shadow', help=shadow.__doc__.strip())
+    p_shadow.add_argument('candidate', nargs='?', default='invoice',
+                          help='engine to compare, e.g. invoice, fixed or cached (default: invoice)')
+    p_shadow.add_argument('--sample-rate', type=float,
+                          help='fraction of invoices to compare (default: 0.01)')
+    p_shadow.add_argument('--obs-date', type=parse_date, default=datetime(2014,1,1),
+                          help='reporting date, YYYY-MM-DD (default: 2014-01-01)')
+    p_shadow.add_argument('--report',
+                          help='path of the mismatch report (default: shadow_report.jsonl)')
+    p_shadow.set_defaults(func=shadow)
+
+    p_scenarios = subcommands.add_parser('scenarios', help=scenarios.__doc__.strip())
+    p_scenarios.add_argument('--obs-date', type=parse_date, default=datetime(2014,1,1),
+                             help='reporting date, YYYY-MM-DD (default: 2014-01-01)')
+    p_scenarios.add_argument('--grace-periods', type=int, nargs='+', metavar='DAYS',
+                             help='grace periods to compare with the current one (default: 7 30)')
+    p_scenarios.set_defaults(func=scenarios)
+
+    p_split_legacy = subcommands.add_parser('split-legacy', help=split_legacy.__doc__.strip())
+    p_split_legacy.set_defaults(func=split_legacy)
+
+    return p
+
+def main(argv=None):
+    """Runs a subcommand, e.g. `python revrec.py recognize --obs-date 2014-01-01`. A
+    refused operation, e.g. closing a period twice, ends the program with its message,
+    see helpers.RevrecError.
+
+    :param argv: Command line arguments, sys.argv[1:] if None.
+    """
+    from helpers import RevrecError
+    p = parser()
+    args = p.parse_args(argv)
+    try:
+        args.func(args)
+    except RevrecError, e:
+        p.exit(1, 'revrec: error: %s\n' % e)
+
 if __name__ == '__main__':
-    print 'Running revenue recognition module...'
-    db = connect_db()
-    seed_db(db)
-    recognize_revenue()
-    mapreduce(db)
\ No newline at end of file
+    main()
\ No newline at end of file
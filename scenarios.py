@@ -0,0 +1,196 @@
+from __future__ import division
+import sys
+from datetime import datetime
+from models import Invoice, InvoiceItem, Payment, Refund, TermExtension
+from use_cases import (amortize_service_fee, apply_grace_period, apply_term_extensions, apply_refunds,
+                       allocate_refunds, rollup_month, FLOW_FIELDS, DEFREV_FIRST, REVENUE_FIRST)
+from recognition import GRACE_PERIOD, CURSOR_BATCH_SIZE
+
+# The current policy, against which every scenario is compared. Keys other than 'name'
+# are keyword arguments of apply_grace_period and apply_refunds.
+BASELINE = {'name': 'baseline', 'grace_period': GRACE_PERIOD}
+
+# Grace periods in days compared with the baseline one by default
+GRACE_PERIODS = [7, 30]
+
+def policy_scenarios(grace_periods=GRACE_PERIODS):
+    """
+    :param grace_periods: Grace periods in days to compare with the baseline.
+    :return list. Policy variants, one per grace period and one per refund ordering. Keys
+                  a variant does not set are taken from the baseline.
+    """
+    scenarios = [{'name': 'grace period of %s days' % days, 'grace_period': days} for days in grace_periods]
+    return scenarios + [{'name': 'cancellation ordering', 'refund_order': DEFREV_FIRST},
+                        {'name': 'service continues ordering', 'refund_order': REVENUE_FIRST}]
+
+SCENARIOS = policy_scenarios()
+
+# Monthly values compared between scenarios
+REPORT_FIELDS = ['cr_rev', 'dr_contra_rev', 'cr_contra_rev', 'dr_reserve_ref', 'dr_reserve_graceperiod',
+                 'ending_defrev']
+
+"""
+-------------------
+PORTFOLIO
+-------------------
+"""
+def load_portfolio(obs_date=datetime(2014,1,1), batch_size=CURSOR_BATCH_SIZE):
+    """Loads every paid invoice with its items and events up to the reporting date.
+    Each collection is read once, instead of once per invoice as in load_invoice_events.
+
+    :param obs_date: Reporting date.
+    :param batch_size: Number of documents fetched per cursor round trip.
+    :return list. Tuples of an Invoice object and its events, see load_invoice_events,
+                  in invoice id order.
+    """
+    invoices = dict((invoice.invoice_id, invoice) for invoice in
+                    read_all(Invoice, {'invoice_date': {'$lte': obs_date}}, batch_size))
+    events = dict((invoice_id, {'invoice_items': [], 'payment': None, 'refunds': [], 'term_extensions': []})
+                  for invoice_id in invoices)
+
+    for item in read_all(InvoiceItem, {}, batch_size):
+        if item.invoice_id in events:
+            events[item.invoice_id]['invoice_items'].append(item)
+    for payment in read_all(Payment, {'payment_date': {'$lte': obs_date}}, batch_size):
+        if payment.invoice_id in events and events[payment.invoice_id]['payment'] is None:
+            events[payment.invoice_id]['payment'] = payment
+    for ref in read_all(Refund, {'refund_date': {'$lte': obs_date}}, batch_size):
+        if ref.invoice_id in events:
+            events[ref.invoice_id]['refunds'].append(ref)
+    for ext in read_all(TermExtension, {'grant_date': {'$lte': obs_date}}, batch_size):
+        if ext.invoice_id in events:
+            events[ext.invoice_id]['term_extensions'].append(ext)
+
+    return [(invoices[invoice_id], events[invoice_id]) for invoice_id in sorted(invoices)
+            if events[invoice_id]['payment'] is not None
+            and invoices[invoice_id].is_paid(events[invoice_id]['payment'])]
+
+def read_all(document, query, batch_size=CURSOR_BATCH_SIZE):
+    """A generator over the documents of a collection that match the query, read through
+    a cursor without the idle timeout, see recognition.iter_invoices.
+    """
+    cursor = document._get_collection().find(query, timeout=False)
+    cursor.batch_size(batch_size)
+    try:
+        for son in cursor:
+            yield document._from_son(son)
+    finally:
+        cursor.close()
+
+"""
+-------------------
+SIMULATION
+-------------------
+"""
+def simulate(portfolio, scenarios=SCENARIOS):
+    """Runs the baseline and every scenario over the portfolio in a single pass and sums
+    the monthly schedules of all items. Nothing is written to the db.
+
+    The parts of an item schedule that no policy changes, i.e. the base amortization,
+    term extensions and refund allocation, are computed once per item and shared by all
+    scenarios. Only the grace period and refunds are applied per scenario, to a copy.
+
+    :param portfolio: Invoices and their events, see load_portfolio.
+    :param scenarios: Policy variants, see policy_scenarios.
+    :return dict. Keyed on scenario name, including the baseline, values are dictionaries
+                  of debits and credits by month, see rollup_month.
+    """
+    policies = [BASELINE] + list(scenarios)
+    totals = dict((policy['name'], {}) for policy in policies)
+
+    for invoice, events in portfolio:
+        payment_date = events['payment'].payment_date
+        items = events['invoice_items']
+        allocations = allocate_refunds(events['refunds'], items, invoice.invoice_amount)
+
+        for item, refund_amounts in zip(items, allocations):
+            base_schedule = amortize_service_fee(item=item, payment_date=payment_date)
+            apply_term_extensions(revrec_schedule=base_schedule,
+                                  item=item,
+                                  term_extensions=events['term_extensions'])
+
+            for policy in policies:
+                policy = dict(BASELINE, **policy)
+                revrec_schedule = dict((date, dict(row)) for date, row in base_schedule.iteritems())
+                apply_grace_period(revrec_schedule=revrec_schedule,
+                                   item=item,
+                                   payment_date=payment_date,
+                                   grace_period=policy.get('grace_period'))
+                apply_refunds(revrec_schedule=revrec_schedule,
+                              invoice_amount=None,
+                              item=item,
+                              refunds=events['refunds'],
+                              refund_amounts=refund_amounts,
+                              refund_order=policy.get('refund_order'))
+                add_months(totals[policy['name']], rollup_month(revrec_schedule))
+
+    return totals
+
+def add_months(total, monthly_schedule):
+    """Adds a monthly schedule to a running total. Modifies the total in place.
+
+    :param total: Dictionary of debits and credits by month.
+    :param monthly_schedule: Dictionary of debits and credits by month, see rollup_month.
+    """
+    for key, values in monthly_schedule.iteritems():
+        month = total.setdefault(key, dict((field, 0) for field in FLOW_FIELDS + ['ending_defrev']))
+        for field, value in values.iteritems():
+            month[field] += value
+
+"""
+-------------------
+REPORTING
+-------------------
+"""
+def monthly_deltas(totals, fields=REPORT_FIELDS):
+    """
+    :param totals: Monthly totals by scenario, see simulate.
+    :param fields: Fields to compare.
+    :return dict. Keyed on scenario name, excluding the baseline, values are lists of
+                  (month, deltas) in month order, where deltas holds the scenario value
+                  less the baseline value of each field.
+    """
+    baseline = totals[BASELINE['name']]
+    deltas = {}
+    for name, total in totals.iteritems():
+        if name == BASELINE['name']:
+            continue
+        months = sorted(set(baseline) | set(total), key=month_order)
+        deltas[name] = [(key, dict((field, total.get(key, {}).get(field, 0) -
+                                           baseline.get(key, {}).get(field, 0)) for field in fields))
+                        for key in months]
+    return deltas
+
+def month_order(key):
+    """
+    :param key: Month key of a monthly schedule, i.e. '2012-3'.
+    :return tuple. Year and month, for sorting.
+    """
+    return tuple(int(x) for x in key.split('-'))
+
+def print_deltas(deltas, fields=REPORT_FIELDS):
+    """Prints the months in which each scenario differs from the baseline.
+    """
+    for name in sorted(deltas):
+        print 'SCENARIO: %s' % name
+        print '%-8s ' % 'month' + ' '.join('%22s' % field for field in fields)
+        for key, values in deltas[name]:
+            if any(round(values[field], 2) for field in fields):
+                print '%-8s ' % key + ' '.join('%22.2f' % values[field] for field in fields)
+        print '---'*60
+
+"""
+-------------------------
+COMMAND LINE EXECUTABLE
+-------------------------
+"""
+if __name__ == '__main__':
+    from recognition import connect_db
+    connect_db()
+
+    # Usage: python scenarios.py [YYYY-MM-DD [GRACE_PERIOD_DAYS ...]]
+    obs_date = datetime.strptime(sys.argv[1], '%Y-%m-%d') if len(sys.argv) > 1 else datetime(2014,1,1)
+    grace_periods = [int(days) for days in sys.argv[2:]] or GRACE_PERIODS
+    portfolio = load_portfolio(obs_date=obs_date)
+    print '%s paid invoices loaded.' % len(portfolio)
+    print_deltas(monthly_deltas(simulate(portfolio, policy_scenarios(grace_periods))))
@@ -0,0 +1,241 @@
+import os
+import hashlib
+import tempfile
+import cPickle as pickle
+from collections import OrderedDict
+
+# Part of every key. Bump it whenever a change to use_cases changes schedule output,
+# so that schedules cached on disk by earlier versions are not reused.
+SCHEDULE_VERSION = 2
+
+# Both tiers are bounded by the pickled size of the cached schedules
+MAX_MEMORY_BYTES = 64 * 1024 * 1024
+MAX_BYTES = 1024 * 1024 * 1024
+
+# Distinguishes a cached None from a miss
+_MISSING = object()
+
+"""
+-------------------
+CACHE KEYS
+-------------------
+"""
+def schedule_key(inputs):
+    """Returns a content hash of the inputs of use_cases.schedule_item. Only the fields
+    that the schedule depends on are hashed, so items of different invoices or accounts
+    with the same amount, term, billperiod, payment date and events share a key.
+
+    :param inputs: Keyword arguments of use_cases.schedule_item.
+    :return string. Hex digest.
+    """
+    item = inputs['item']
+    snapshot = inputs['snapshot']
+    normalized = (
+        SCHEDULE_VERSION,
+        (item.total_amount, normalize_date(item.service_start), normalize_date(item.service_end),
+         item.billperiod),
+        normalize_date(inputs['payment_date']),
+        [(normalize_date(ref.refund_date), bool(ref.cancel_flag), amount)
+         for ref, amount in zip(inputs['refunds'], inputs['refund_amounts'])],
+        [(normalize_date(ext.grant_date), normalize_date(ext.service_start),
+          normalize_date(ext.service_end)) for ext in inputs['term_extensions']],
+        inputs['scale'],
+        (snapshot.ending_defrev, snapshot.cumul_rev) if snapshot is not None else None,
+        normalize_date(inputs['open_start']),
+        inputs.get('grace_period'),
+        inputs.get('refund_order')
+    )
+    return hashlib.sha1(repr(normalized)).hexdigest()
+
+def normalize_date(dte):
+    """
+    :param dte: A datetime or None.
+    :return string. ISO representation of the datetime, or None.
+    """
+    return dte.isoformat() if dte is not None else None
+
+def compact(results, scale=None):
+    """Reduces a use_cases.schedule_item result to the part that is cached: the monthly
+    schedule, the grace period notes and, for fixed-point schedules, the fixed daily
+    schedule. A daily float schedule holds a dict per day, about 341KB for a yearly item,
+    and is replaced by None.
+
+    :param results: Result of schedule_item, or None.
+    :param scale: Fixed-point scale of the schedule, or None.
+    :return dict. The cached result, or None.
+    """
+    if results is None:
+        return None
+    return {
+        'revrec_schedule': results['revrec_schedule'] if scale is not None else None,
+        'monthly_schedule': results['monthly_schedule'],
+        'gp_notes': results['gp_notes']
+    }
+
+"""
+-------------------
+SCHEDULE CACHE
+-------------------
+"""
+class ScheduleCache(object):
+    """
+    A two-tier cache of item schedules keyed on schedule_key: an in-process LRU tier
+    and an optional on-disk tier, shared by processes and kept across runs. Only the
+    compact form of each schedule is cached, see compact. Cached schedules are shared
+    between callers and must not be modified.
+    """
+
+    def __init__(self, max_memory_bytes=MAX_MEMORY_BYTES, directory=None, max_bytes=MAX_BYTES):
+        """
+        :param max_memory_bytes: Pickled size of the in-process tier above which the least
+                                 recently used schedules are evicted.
+        :param directory: Directory of the on-disk tier. No on-disk tier if None.
+        :param max_bytes: Size of the on-disk tier above which the least recently used
+                          files are evicted.
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_bytes = 0
+
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.disk_bytes = sum(size for path, size, mtime in self.disk_files())
+
+    def get_or_compute(self, inputs, compute):
+        """Returns the cached schedule for the inputs, computing and caching it on a miss.
+        Misses return the compact form too, so that every caller sees the same result.
+
+        :param inputs: Keyword arguments of compute.
+        :param compute: Function that computes the schedule, i.e. use_cases.schedule_item.
+        """
+        key = schedule_key(inputs)
+
+        entry = self.memory.pop(key, _MISSING)
+        if entry is not _MISSING:
+            self.hits += 1
+            self.memory[key] = entry
+            return entry[0]
+
+        value, size = self.read(key)
+        if value is not _MISSING:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            value = compact(compute(**inputs), inputs['scale'])
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            size = len(data)
+            self.write(key, data)
+
+        self.remember(key, value, size)
+        return value
+
+    def remember(self, key, value, size):
+        """Adds a schedule to the in-process tier and evicts the least recently used ones
+        while the tier is over max_memory_bytes. A schedule larger than the whole tier
+        is not kept.
+
+        :param size: Pickled size of the schedule in bytes.
+        """
+        if size > self.max_memory_bytes:
+            return
+        self.memory[key] = (value, size)
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_memory_bytes:
+            evicted_value, evicted_size = self.memory.popitem(last=False)[1]
+            self.memory_bytes -= evicted_size
+
+    def path(self, key):
+        """
+        :return string. Path of the on-disk file of a key, sharded on its first characters.
+        """
+        return os.path.join(self.directory, key[:2], key)
+
+    def read(self, key):
+        """
+        :return tuple. The schedule stored on disk for the key and its pickled size, or
+                       (_MISSING, None).
+        """
+        if self.directory is None:
+            return _MISSING, None
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            value = pickle.loads(data)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return _MISSING, None
+
+        # Mark the file as recently used for eviction. Another process may have evicted it
+        # since it was read.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value, len(data)
+
+    def write(self, key, data):
+        """Stores a pickled schedule on disk. The file is written under a temporary name
+        and renamed into place, so concurrent readers never see a partial file.
+        """
+        if self.directory is None:
+            return
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+        self.disk_bytes += os.path.getsize(path)
+        if self.disk_bytes > self.max_bytes:
+            self.evict()
+
+    def disk_files(self):
+        """
+        :return list. Tuples of (path, size, mtime) of the files of the on-disk tier.
+        """
+        files = []
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def evict(self):
+        """Removes the least recently used files of the on-disk tier until it is back
+        under 90% of max_bytes, leaving room for new schedules before the next eviction.
+        """
+        files = sorted(self.disk_files(), key=lambda f: f[2])
+        self.disk_bytes = sum(size for path, size, mtime in files)
+        for path, size, mtime in files:
+            if self.disk_bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.disk_bytes -= size
+
+    def stats(self):
+        """
+        :return dict. Number of in-process hits, on-disk hits and misses, and the pickled
+                      size of the in-process tier.
+        """
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'memory_bytes': self.memory_bytes}
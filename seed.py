@@ -2,10 +2,8 @@ import pymongo
 import random
 from datetime import datetime, timedelta
 from helpers import gen_id, get_next_renewal_date
-from mongoengine import *
-from models import *
-
-connect('revrec')
+from models import Invoice, InvoiceItem, Payment, Refund, TermExtension
+from ledger import drop_partitions, LEGACY_COLLECTION
 
 def seed_db(db):
     """
@@ -17,14 +15,21 @@ def seed_db(db):
 
 def clear_collections(db):
     """
-    Clear Mongo collections.
+    Clear Mongo collections, including the period closes, snapshots and run state
+    that refer to the old data. Ledger partitions are dropped whole.
     """
     db['invoice'].remove()
     db['invoice_item'].remove()
     db['payment'].remove()
     db['refund'].remove()
     db['term_extension'].remove()
-    db['monthly_entry'].remove()
+    db['period_close'].remove()
+    db['item_snapshot'].remove()
+    db['recognition_job'].remove()
+    db['job_chunk'].remove()
+    db['ledger_run'].remove()
+    db.drop_collection(LEGACY_COLLECTION)
+    drop_partitions()
 
 def gen_invoice():
     """
@@ -0,0 +1,265 @@
+from __future__ import division
+import sys
+import json
+import time
+import hashlib
+from datetime import datetime, timedelta
+from use_cases import (amortize_service_fee, apply_grace_period, apply_term_extensions, apply_refunds,
+                       rollup_month, schedule_invoice, from_units, FLOW_FIELDS, BALANCE_FIELDS)
+from schedule_cache import ScheduleCache
+from recognition import iter_invoices, load_invoice_events, CURSOR_BATCH_SIZE
+
+SAMPLE_RATE = 0.01
+DAILY_TOLERANCE = 0.005
+MONTHLY_TOLERANCE = 0.01
+REPORT_PATH = 'shadow_report.jsonl'
+
+# Maximum number of differing values recorded per mismatched invoice
+MAX_DIFFS = 20
+
+"""
+-------------------
+ENGINES
+-------------------
+"""
+def reference_engine(invoice, events):
+    """The reference path: each item is scheduled on its own with the dict-based
+    use_cases functions, as process_invoice originally did.
+
+    :return dict. Keyed on item id, values hold the 'daily' and 'monthly' schedules.
+    """
+    payment_date = events['payment'].payment_date
+    schedules = {}
+    for item in events['invoice_items']:
+        revrec_schedule = amortize_service_fee(item=item, payment_date=payment_date)
+        apply_grace_period(revrec_schedule=revrec_schedule, item=item, payment_date=payment_date)
+        apply_term_extensions(revrec_schedule=revrec_schedule, item=item,
+                              term_extensions=events['term_extensions'])
+        apply_refunds(revrec_schedule=revrec_schedule, invoice_amount=invoice.invoice_amount,
+                      item=item, refunds=events['refunds'])
+        schedules[item.item_id] = {'daily': revrec_schedule, 'monthly': rollup_month(revrec_schedule)}
+    return schedules
+
+def invoice_engine(invoice, events, scale=None, cache=None):
+    """The invoice-level engine, use_cases.schedule_invoice.
+
+    :param scale: Fixed-point scale, or None for float schedules.
+    :param cache: Optional ScheduleCache.
+    :return dict. Keyed on item id, values hold the 'daily' and 'monthly' schedules in
+                  currency units. 'daily' is left out for float schedules read through
+                  the cache, which only keeps their monthly schedules.
+    """
+    results = schedule_invoice(invoice_amount=invoice.invoice_amount,
+                               items=events['invoice_items'],
+                               payment_date=events['payment'].payment_date,
+                               refunds=events['refunds'],
+                               term_extensions=events['term_extensions'],
+                               scale=scale,
+                               cache=cache)
+
+    schedules = {}
+    for r in results['items']:
+        daily = r['revrec_schedule']
+        monthly = r['monthly_schedule']
+        if scale is not None:
+            daily = daily_from_fixed(daily)
+            monthly = dict((month, dict((k, from_units(v, scale)) for k, v in values.iteritems()))
+                           for month, values in monthly.iteritems())
+        schedules[r['item'].item_id] = {'monthly': monthly}
+        if daily is not None:
+            schedules[r['item'].item_id]['daily'] = daily
+    return schedules
+
+def daily_from_fixed(fixed):
+    """
+    :param fixed: Fixed schedule, see use_cases.fixed_schedule.
+    :return dict. Daily schedule of debits and credits in currency units.
+    """
+    return dict((fixed['start'] + timedelta(n),
+                 dict((field, from_units(fixed[field][n], fixed['scale']))
+                      for field in FLOW_FIELDS + BALANCE_FIELDS))
+                for n in range(fixed['days']))
+
+SHADOW_CACHE = ScheduleCache()
+
+# Fixed-point scale of the candidate engines that round to units. Their daily and monthly
+# values are within a unit of the reference, e.g. a $20 item over 30 days gets 66 or 67
+# cents a day, so their tolerances are at least a unit, see candidate_tolerances.
+ENGINE_SCALES = {'fixed': 100}
+
+ENGINES = {
+    'reference': reference_engine,
+    'invoice': invoice_engine,
+    'fixed': lambda invoice, events: invoice_engine(invoice, events, scale=ENGINE_SCALES['fixed']),
+    'cached': lambda invoice, events: invoice_engine(invoice, events, cache=SHADOW_CACHE)
+}
+
+"""
+-------------------
+SHADOW RUNS
+-------------------
+"""
+def run_shadow(candidate='invoice', sample_rate=SAMPLE_RATE, obs_date=datetime(2014,1,1),
+               daily_tolerance=DAILY_TOLERANCE, monthly_tolerance=MONTHLY_TOLERANCE,
+               report_path=REPORT_PATH):
+    """Runs a sample of invoices through the reference engine and a candidate engine side
+    by side and compares their daily and monthly schedules. Nothing is written to the db.
+
+    Invoices are sampled on a hash of their id, so the same sample is drawn on every run.
+    Each mismatch is written as a JSON line to the report, together with the invoice, its
+    items and its events, which is all that is needed to reproduce it.
+
+    :param candidate: Name of the candidate engine in ENGINES.
+    :param sample_rate: Fraction of invoices to compare.
+    :param obs_date: Reporting date.
+    :param daily_tolerance: Largest absolute daily difference that is not a mismatch.
+    :param monthly_tolerance: Largest absolute monthly difference that is not a mismatch.
+                              Both are raised to a unit for fixed-point candidates.
+    :param report_path: Path of the mismatch report.
+    :return dict. Number of invoices compared and mismatched, seconds per engine and speedup.
+    """
+    reference = ENGINES['reference']
+    engine = ENGINES[candidate]
+    daily_tolerance, monthly_tolerance = candidate_tolerances(candidate, daily_tolerance,
+                                                              monthly_tolerance)
+    summary = {'candidate': candidate, 'compared': 0, 'mismatched': 0,
+               'reference_seconds': 0.0, 'candidate_seconds': 0.0}
+
+    with open(report_path, 'w') as report:
+        for invoice in iter_invoices(obs_date=obs_date, batch_size=CURSOR_BATCH_SIZE):
+            if not sampled(invoice.invoice_id, sample_rate):
+                continue
+            events = load_invoice_events(invoice, obs_date=obs_date)
+            payment = events['payment']
+            if payment is None or not invoice.is_paid(payment):
+                continue
+
+            expected, summary['reference_seconds'] = timed(reference, invoice, events,
+                                                           summary['reference_seconds'])
+            actual, summary['candidate_seconds'] = timed(engine, invoice, events,
+                                                         summary['candidate_seconds'])
+            summary['compared'] += 1
+
+            diffs = diff_schedules(expected, actual, daily_tolerance, monthly_tolerance)
+            if diffs:
+                summary['mismatched'] += 1
+                report.write(json.dumps({'invoice_id': invoice.invoice_id,
+                                         'candidate': candidate,
+                                         'diffs': diffs[:MAX_DIFFS],
+                                         'diff_count': len(diffs),
+                                         'inputs': serialize_inputs(invoice, events)}) + '\n')
+
+    summary['speedup'] = (summary['reference_seconds'] / summary['candidate_seconds']
+                          if summary['candidate_seconds'] else None)
+    print 'Shadow run of %(candidate)s: %(compared)s invoices compared, %(mismatched)s mismatched. ' \
+          'Reference %(reference_seconds).2fs, candidate %(candidate_seconds).2fs.' % summary
+    if summary['speedup'] is not None:
+        print 'Speedup: %.2fx' % summary['speedup']
+    return summary
+
+def candidate_tolerances(candidate, daily_tolerance=DAILY_TOLERANCE,
+                         monthly_tolerance=MONTHLY_TOLERANCE):
+    """
+    :param candidate: Name of the candidate engine in ENGINES.
+    :return tuple. The daily and monthly tolerances of the candidate, at least one unit of
+                   1/scale for a fixed-point candidate, see ENGINE_SCALES.
+    """
+    scale = ENGINE_SCALES.get(candidate)
+    if scale is None:
+        return daily_tolerance, monthly_tolerance
+    return max(daily_tolerance, 1 / scale), max(monthly_tolerance, 1 / scale)
+
+def sampled(invoice_id, sample_rate):
+    """
+    :return boolean. True if the invoice falls into the sample.
+    """
+    return int(hashlib.sha1(invoice_id).hexdigest()[:8], 16) < sample_rate * 0x100000000
+
+def timed(engine, invoice, events, elapsed):
+    """Runs an engine on an invoice. An exception is recorded as the engine's result,
+    so that it shows up as a mismatch instead of ending the run.
+
+    :return tuple. The engine's schedules, and elapsed plus the seconds it took.
+    """
+    started = time.time()
+    try:
+        schedules = engine(invoice, events)
+    except Exception, e:
+        schedules = {'error': '%s: %s' % (type(e).__name__, e)}
+    return schedules, elapsed + time.time() - started
+
+def diff_schedules(expected, actual, daily_tolerance=DAILY_TOLERANCE,
+                   monthly_tolerance=MONTHLY_TOLERANCE):
+    """Compares the schedules of two engines value by value. Daily schedules are only
+    compared for items for which the candidate produces them.
+
+    :param expected: Schedules of the reference engine, keyed on item id.
+    :param actual: Schedules of the candidate engine, keyed on item id.
+    :return list. Differences as dicts with the item, 'daily' or 'monthly', the day or month,
+                  the field and both values. A missing value is None.
+    """
+    if 'error' in expected or 'error' in actual:
+        if expected.get('error') == actual.get('error'):
+            return []
+        return [{'error': {'expected': expected.get('error'), 'actual': actual.get('error')}}]
+
+    diffs = []
+    for item_id in sorted(set(expected) | set(actual)):
+        for period, tolerance in [('daily', daily_tolerance), ('monthly', monthly_tolerance)]:
+            if period == 'daily' and item_id in actual and 'daily' not in actual[item_id]:
+                continue
+            e = expected.get(item_id, {}).get(period, {})
+            a = actual.get(item_id, {}).get(period, {})
+            for key in sorted(set(e) | set(a)):
+                e_values = e.get(key, {})
+                a_values = a.get(key, {})
+                for field in sorted(set(e_values) | set(a_values)):
+                    e_value = e_values.get(field)
+                    a_value = a_values.get(field)
+                    if e_value is None or a_value is None or abs(e_value - a_value) > tolerance:
+                        diffs.append({'invoice_item_id': item_id,
+                                      'period': period,
+                                      'key': str(key)[:10],
+                                      'field': field,
+                                      'expected': e_value,
+                                      'actual': a_value})
+    return diffs
+
+def serialize_inputs(invoice, events):
+    """
+    :return dict. The invoice, its items and events as JSON-serializable dicts.
+    """
+    return {
+        'invoice': serialize_document(invoice),
+        'invoice_items': [serialize_document(item) for item in events['invoice_items']],
+        'payment': serialize_document(events['payment']),
+        'refunds': [serialize_document(ref) for ref in events['refunds']],
+        'term_extensions': [serialize_document(ext) for ext in events['term_extensions']]
+    }
+
+def serialize_document(document):
+    """
+    :param document: A mongoengine Document.
+    :return dict. The document's fields other than its id, with dates as ISO strings.
+    """
+    values = {}
+    for name in document._fields:
+        if name == 'id':
+            continue
+        value = getattr(document, name)
+        values[name] = value.isoformat() if isinstance(value, datetime) else value
+    return values
+
+"""
+-------------------------
+COMMAND LINE EXECUTABLE
+-------------------------
+"""
+if __name__ == '__main__':
+    from recognition import connect_db
+    connect_db()
+
+    candidate = sys.argv[1] if len(sys.argv) > 1 else 'invoice'
+    sample_rate = float(sys.argv[2]) if len(sys.argv) > 2 else SAMPLE_RATE
+    summary = run_shadow(candidate=candidate, sample_rate=sample_rate)
+    sys.exit(1 if summary['mismatched'] else 0)
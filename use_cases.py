@@ -1,7 +1,23 @@
 from __future__ import division
+from array import array
+from calendar import monthrange
 from datetime import datetime, timedelta, date
 from helpers import daterange, pretty_date, days_elapsed, day_before, last_day_of_month
 
+# Debit and credit fields of a schedule that are flows, i.e. summed over a period.
+FLOW_FIELDS = ['cr_rev', 'dr_defrev', 'cr_ref_payable', 'dr_reserve_ref', 'dr_contra_rev',
+               'dr_reserve_graceperiod', 'cr_contra_rev']
+
+# Fields of a schedule that are balances as of the end of the day.
+BALANCE_FIELDS = ['ending_defrev', 'cumul_rev']
+
+# The flow field that moves each balance field, and the sign with which it does.
+BALANCE_FLOWS = {'ending_defrev': ('dr_defrev', -1), 'cumul_rev': ('cr_rev', 1)}
+
+# Orders in which a refund is applied, see refund_calc.
+DEFREV_FIRST = 'defrev_first'
+REVENUE_FIRST = 'revenue_first'
+
 def create_schedule(values={}):
     """Returns a daily schedule of debits and credits.
     
@@ -91,7 +107,53 @@ def amortize_service_fee(item, payment_date):
 
     return revrec_schedule
 
-def apply_grace_period(revrec_schedule, item, payment_date):
+def resume_service_fee(item, snapshot, open_start, service_end=None):
+    """
+    Creates a daily revenue recognition schedule for the specified invoice item from the
+    first day of the open periods on, continuing from the item's closed-period snapshot.
+    The remaining deferred revenue is amortized daily through the end of the service term.
+
+    The schedule starts with an opening row on the close date, which carries the balances
+    of the snapshot and, as cr_rev, the revenue recognized to date, so that adjustments
+    see the same history as on a full schedule. The caller removes it before rollup.
+
+    :param item: InvoiceItem object.
+    :param snapshot: ItemSnapshot object of the item at the close boundary.
+    :param open_start: First day of the open periods.
+    :param service_end: End of the service term including term extensions granted before
+                        the open periods. Defaults to the item's service end.
+    :return dict. Daily revrec schedule of debit and credit journal entries.
+    """
+    if service_end is None:
+        service_end = item.service_end
+
+    revrec_schedule = {}
+    revrec_schedule[day_before(open_start)] = create_schedule({
+        'cr_rev': snapshot.cumul_rev,
+        'ending_defrev': snapshot.ending_defrev,
+        'cumul_rev': snapshot.cumul_rev
+    })
+
+    if service_end < open_start:
+        return revrec_schedule
+
+    defrev = snapshot.ending_defrev
+    daily_amort = defrev / days_elapsed(open_start, service_end)
+    cumul_rev = snapshot.cumul_rev
+
+    for date in daterange(open_start, service_end):
+        defrev = defrev - daily_amort
+        cumul_rev += daily_amort
+        revrec_schedule[date] = create_schedule({
+            'cr_rev': daily_amort,
+            'dr_defrev': daily_amort,
+            'ending_defrev': defrev,
+            'cumul_rev': cumul_rev
+        })
+
+    return revrec_schedule
+
+def apply_grace_period(revrec_schedule, item, payment_date, grace_period=None):
     """Adjusts the specified revrec schedule for late payment, which requires journal entries 
     related to grace period.
 
@@ -99,6 +161,8 @@ def apply_grace_period(revrec_schedule, item, payment_date):
                             application of grace period.
     :param item: InvoiceItem object
     :param payment_date: Date of payment
+    :param grace_period: Maximum number of late days covered by the grace period. Later days
+                         are not reserved for. No limit if None.
     :return list. Supporting notes on grace period calculations. Displayed in UI output. 
     """
     gp_notes = []
@@ -135,9 +199,13 @@ def apply_grace_period(revrec_schedule, item, payment_date):
         prev_service_start,
         prev_reporting_day))
 
+    last_grace_day = day_before(payment_date)
+    if grace_period is not None:
+        last_grace_day = min(last_grace_day, service_start + timedelta(grace_period - 1))
+
     # For each date that payment is late...
     running_total_dr_reserve = 0
-    for date in daterange(service_start, day_before(payment_date)):
+    for date in daterange(service_start, last_grace_day):
 
         # The previous service term is extended by the grace period used
         revised_service_term = prev_service_term + days_elapsed(service_start, date)
@@ -179,19 +247,28 @@ def apply_grace_period(revrec_schedule, item, payment_date):
     gp_notes.append('---'*60)
     return gp_notes
 
-def apply_refunds(revrec_schedule, invoice_amount, item, refunds):
+def apply_refunds(revrec_schedule, invoice_amount, item, refunds, refund_amounts=None,
+                  revrec_start_date=None, refund_order=None):
     """Adjusts the specified revrec schedule for refunds.
 
     :param revrec_schedule: Dictionary of debits and credits by day
     :param invoice_amount: Total amount of the invoice
     :param item: The Item object
     :param refunds: Refund objects
+    :param refund_amounts: Portions of each refund applied to this item, see allocate_refunds.
+                           If not specified, they are computed pro rata from invoice_amount.
+    :param revrec_start_date: Date from which revenue recognition begins. Defaults to the first
+                              day of the schedule.
+    :param refund_order: Order in which refunds are applied, see refund_calc.
     """
-    # Adjustment amortization due to refunds
-    for ref in refunds:
+    if revrec_start_date is None:
+        revrec_start_date = min(revrec_schedule.keys())
+
+    if refund_amounts is None:
+        refund_amounts = allocate_refunds(refunds, [item], invoice_amount)[0]
 
-        proportion = item.total_amount/invoice_amount
-        refund_applied = ref.refund_amount * proportion
+    # Adjustment amortization due to refunds
+    for ref, refund_applied in zip(refunds, refund_amounts):
 
         last_day_of_schedule = max(revrec_schedule.keys())
 
@@ -211,10 +288,11 @@ def apply_refunds(revrec_schedule, invoice_amount, item, refunds):
 
         # Calculate debits and credits associated with refund event
         results = refund_calc(flags=flags, 
-                              revrec_start_date=min(revrec_schedule.keys()), 
+                              revrec_start_date=revrec_start_date, 
                               refund_date=ref.refund_date, 
                               refund_amount=refund_applied,
-                              stats_as_of_refund_date=stats_as_of_refund_date)
+                              stats_as_of_refund_date=stats_as_of_refund_date,
+                              refund_order=refund_order)
 
         # Remaining deferred revenue
         remaining_defrev = stats_as_of_refund_date['ending_defrev'] - results['dr_defrev']
@@ -245,7 +323,20 @@ def apply_refunds(revrec_schedule, invoice_amount, item, refunds):
                             start_date=ref.refund_date, 
                             end_date=last_day_of_schedule)
 
-def refund_calc(flags, revrec_start_date, refund_date, refund_amount, stats_as_of_refund_date):
+def allocate_refunds(refunds, items, invoice_amount):
+    """Allocates each refund across invoice items in proportion to the item amounts.
+
+    :param refunds: Refund objects
+    :param items: InvoiceItem objects
+    :param invoice_amount: Total amount of the invoice
+    :return list. For each item, in order, the list of amounts applied from each refund.
+    """
+    proportions = [item.total_amount / invoice_amount for item in items]
+    refund_amounts = [ref.refund_amount for ref in refunds]
+    return [[amount * proportion for amount in refund_amounts] for proportion in proportions]
+
+def refund_calc(flags, revrec_start_date, refund_date, refund_amount, stats_as_of_refund_date,
+                refund_order=None):
     """Returns a dictionary of debit and credit journal entries associated with the refund that take effect 
     on the day of the refund.
 
@@ -267,6 +358,8 @@ def refund_calc(flags, revrec_start_date, refund_date, refund_amount, stats_as_o
                                      refund date.
     :param as_of_refund_date.ending_defrev: Deferred revenue balance at the beginning of the refund date.
     :param refund_amount: Amount of the refund (part of Refund object).
+    :param refund_order: DEFREV_FIRST or REVENUE_FIRST to apply every refund in that order
+                         regardless of cancellation. If None, the order follows flags.cancel_flag.
     :return dict. Contains calculated debit and credit journal entries associated with the refund: 
                   DR deferred revenue, DR reserve for refunds, DR contra-revenue, CR refunds payable.
     """
@@ -276,12 +369,13 @@ def refund_calc(flags, revrec_start_date, refund_date, refund_amount, stats_as_o
 
     positive_item_amount = flags['positive_item_amount']
     service_cancelled = flags['service_cancelled']
+    defrev_first = service_cancelled if refund_order is None else refund_order == DEFREV_FIRST
 
     defrev = abs(stats_as_of_refund_date['ending_defrev'])
     rev = abs(stats_as_of_refund_date['cr_rev'])
 
     # Service term is cancelled, refund goes against deferred revenue first
-    if service_cancelled:
+    if defrev_first:
 
         # Debit to deferred revenue
         dr_defrev = min(refund_amount, defrev)
@@ -333,13 +427,399 @@ def apply_term_extensions(item, revrec_schedule, term_extensions):
 
         for date in daterange(start, end):
             defrev = defrev - daily_amort
-            template = dict(revrec_daily_template)
-            template['cr_rev'] = daily_amort
-            template['dr_defrev'] = daily_amort
-            template['ending_defrev'] = defrev
+            template = create_schedule({
+                'cr_rev': daily_amort,
+                'dr_defrev': daily_amort,
+                'ending_defrev': defrev
+            })
 
             try:
                 revrec_schedule[date]['cr_rev'] = daily_amort
                 revrec_schedule[date]['ending_defrev'] = defrev
             except KeyError:
-                revrec_schedule[date] = template
\ No newline at end of file
+                revrec_schedule[date] = template
+
+def schedule_invoice(invoice_amount, items, payment_date, refunds, term_extensions, scale=None,
+                     snapshots=None, open_start=None, cache=None, grace_period=None,
+                     refund_order=None, daily_total=False):
+    """Creates the revenue recognition schedules of all items of an invoice at once.
+
+    Refunds are allocated across the items in a single step and each item schedule is
+    built and adjusted. Daily and monthly schedules are returned for every item, along
+    with the monthly invoice total. The daily invoice total, i.e. the item schedules
+    merged onto the shared day axis of the invoice, is only built on request, as the
+    ledger is written from the monthly item schedules.
+
+    :param invoice_amount: Total amount of the invoice.
+    :param items: InvoiceItem objects.
+    :param payment_date: Date of payment.
+    :param refunds: Refund objects.
+    :param term_extensions: TermExtension objects.
+    :param scale: If set, schedules are returned in fixed-point units of 1/scale, e.g. cents
+                  for 100, see fixed_schedule. Daily schedules are then fixed schedules and
+                  monthly schedules hold integer units.
+    :param snapshots: If set, a list aligned with :param items of the closed-period snapshots
+                      of the items, or None for items without one, see resume_service_fee.
+    :param open_start: First day of the open periods. Required with :param snapshots.
+                       Items are only scheduled from this day on; activity of items without
+                       a snapshot that falls into closed months is booked in the first open
+                       month, see fold_closed_months.
+    :param cache: Optional schedule_cache.ScheduleCache. Item schedules with the same inputs
+                  are then computed once and shared, so they must not be modified. Only
+                  their compact form is cached, in which the daily schedules of float
+                  items are None, so the cache is not used with :param daily_total.
+    :param grace_period: Maximum number of late days covered by the grace period, see
+                         apply_grace_period.
+    :param refund_order: Order in which refunds are applied, see refund_calc.
+    :param daily_total: True to build the daily invoice total.
+    :return dict. 'items' is a list of dicts with the 'item', its daily 'revrec_schedule',
+                  its 'monthly_schedule' and its 'gp_notes', in the order of :param items.
+                  Resumed items with nothing left to schedule are omitted.
+                  'revrec_schedule' and 'monthly_schedule' hold the invoice totals, the
+                  former None unless :param daily_total is True.
+    """
+    allocations = allocate_refunds(refunds, items, invoice_amount)
+
+    item_results = []
+    for n, (item, refund_amounts) in enumerate(zip(items, allocations)):
+        inputs = {
+            'item': item,
+            'payment_date': payment_date,
+            'refunds': refunds,
+            'refund_amounts': refund_amounts,
+            'term_extensions': term_extensions,
+            'scale': scale,
+            'snapshot': snapshots[n] if snapshots else None,
+            'open_start': open_start,
+            'grace_period': grace_period,
+            'refund_order': refund_order
+        }
+        if cache is None or daily_total:
+            results = schedule_item(**inputs)
+        else:
+            results = cache.get_or_compute(inputs, schedule_item)
+
+        if results is not None:
+            item_results.append(dict(results, item=item))
+
+    revrec_schedule = None
+    if daily_total:
+        daily_schedules = [r['revrec_schedule'] for r in item_results]
+        revrec_schedule = (merge_schedules(daily_schedules) if scale is None
+                           else merge_fixed_schedules(daily_schedules, scale))
+
+    return {
+        'items': item_results,
+        'revrec_schedule': revrec_schedule,
+        'monthly_schedule': merge_schedules([r['monthly_schedule'] for r in item_results])
+    }
+
+def schedule_item(item, payment_date, refunds, refund_amounts, term_extensions, scale=None,
+                  snapshot=None, open_start=None, grace_period=None, refund_order=None):
+    """Creates the revenue recognition schedule of a single invoice item. The result
+    depends on these inputs only, see schedule_invoice for their meaning.
+
+    :param refund_amounts: Portions of each refund applied to this item, see allocate_refunds.
+    :param snapshot: Closed-period snapshot of the item, or None. An item paid after the
+                     close has no balances to continue from, as its closed months only hold
+                     grace period entries. It is scheduled in full instead, and the closed
+                     days, which are already in the ledger, are dropped.
+    :return dict. The daily 'revrec_schedule', the 'monthly_schedule' and the 'gp_notes' of
+                  the item, or None if a resumed item has nothing left to schedule.
+    """
+    revrec_start_date = None
+    gp_notes = []
+    resumed = snapshot is not None and payment_date < open_start
+
+    if not resumed:
+
+        # Generate base amortization schedule based on amount, service term, payment date.
+        revrec_schedule = amortize_service_fee(item=item, payment_date=payment_date)
+
+        # Adjust the schedule in the case of a late payment, i.e. when the grace period is used.
+        gp_notes = apply_grace_period(revrec_schedule=revrec_schedule,
+                                      item=item,
+                                      payment_date=payment_date,
+                                      grace_period=grace_period)
+    else:
+
+        # Continue from the snapshot. Events before the open periods are already part of it.
+        prior_extensions = [ext for ext in term_extensions if ext.grant_date < open_start]
+        revrec_schedule = resume_service_fee(item=item,
+                                             snapshot=snapshot,
+                                             open_start=open_start,
+                                             service_end=max([item.service_end] +
+                                                 [ext.service_end for ext in prior_extensions]))
+        term_extensions = [ext for ext in term_extensions if ext.grant_date >= open_start]
+        open_refunds = [(ref, amount) for ref, amount in zip(refunds, refund_amounts)
+                        if ref.refund_date >= open_start]
+        refunds = [ref for ref, amount in open_refunds]
+        refund_amounts = [amount for ref, amount in open_refunds]
+        # Same as the first day of a full schedule
+        revrec_start_date = item.service_start
+
+    # Adjust the schedule for term extensions
+    apply_term_extensions(revrec_schedule=revrec_schedule,
+                          item=item,
+                          term_extensions=term_extensions)
+
+    # Adjust the schedule for refunds. The invoice amount is not needed, as the refund
+    # amounts of the item are already allocated.
+    apply_refunds(revrec_schedule=revrec_schedule,
+                  invoice_amount=None,
+                  item=item,
+                  refunds=refunds,
+                  refund_amounts=refund_amounts,
+                  revrec_start_date=revrec_start_date,
+                  refund_order=refund_order)
+
+    # The opening row of a resumed schedule belongs to the closed period, as do the closed
+    # days of an item with a snapshot that was paid after the close
+    if resumed:
+        del revrec_schedule[day_before(open_start)]
+    elif snapshot is not None:
+        for date in [date for date in revrec_schedule if date < open_start]:
+            del revrec_schedule[date]
+    if snapshot is not None and not revrec_schedule:
+        return None
+
+    if scale is not None:
+        revrec_schedule = fixed_schedule(revrec_schedule, scale)
+
+    monthly_schedule = (rollup_month(revrec_schedule) if scale is None
+                        else rollup_month_fixed(revrec_schedule))
+    if open_start is not None and snapshot is None:
+        fold_closed_months(monthly_schedule, open_start)
+
+    return {
+        'revrec_schedule': revrec_schedule,
+        'monthly_schedule': monthly_schedule,
+        'gp_notes': gp_notes
+    }
+
+def merge_schedules(schedules):
+    """Sums schedules of debits and credits over the union of their keys. Works on daily
+    as well as monthly schedules. Flow fields are summed on each key. Balance fields are
+    balances, not flows: a schedule adds nothing to them before its first key, and its
+    latest balance on every key after that, including the keys past its end.
+
+    :param schedules: List of dictionaries of debits and credits, keyed by day or month.
+    :return dict. Dictionary of summed debits and credits over the union of the keys.
+    """
+    keys = sorted(set(key for schedule in schedules for key in schedule), key=schedule_order)
+    merged = dict((key, {}) for key in keys)
+    for schedule in schedules:
+        if not schedule:
+            continue
+        balances = {}
+        first = schedule_order(min(schedule, key=schedule_order))
+        for key in keys:
+            if schedule_order(key) < first:
+                continue
+            total = merged[key]
+            for field, value in schedule.get(key, {}).iteritems():
+                if field in BALANCE_FIELDS:
+                    balances[field] = value
+                else:
+                    total[field] = total.get(field, 0) + value
+            for field, value in balances.iteritems():
+                total[field] = total.get(field, 0) + value
+    return merged
+
+def schedule_order(key):
+    """
+    :param key: Day of a daily schedule, or month of a monthly schedule, i.e. '2012-3'.
+    :return Value that sorts schedule keys in date order.
+    """
+    if isinstance(key, basestring):
+        return tuple(int(x) for x in key.split('-'))
+    return key
+
+"""
+--------------------
+DICTIONARY ROLLUPS
+--------------------
+"""
+def rollup_month(revrec_schedule):
+    """Rolls up daily revenue schedule and returns a monthly schedule in dictionary form
+    keyed on month, i.e. '2012-01'.
+
+    :param revrec_schedule: Dictionary of debits and credits by day
+    :return dict. Dictionary of debits and credits by month
+    """
+    rollup = {}
+    dates = revrec_schedule.keys()
+    start_date = min(dates)
+    end_date = max(dates)
+    for date, value in revrec_schedule.iteritems():
+        key = '%s-%s' % (date.year, date.month)
+        try:
+            rollup[key]['cr_rev'] += value['cr_rev']
+            rollup[key]['cr_ref_payable'] += value['cr_ref_payable']
+            rollup[key]['dr_reserve_ref'] += value['dr_reserve_ref']
+            rollup[key]['dr_contra_rev'] += value['dr_contra_rev']
+            rollup[key]['dr_defrev'] += value['dr_defrev']
+            rollup[key]['dr_reserve_graceperiod'] += value['dr_reserve_graceperiod']
+            rollup[key]['cr_contra_rev'] += value['cr_contra_rev']
+        except KeyError:
+            rollup[key] = { 
+                'cr_rev': value['cr_rev'], 
+                'ending_defrev': 0,
+                'cr_ref_payable': value['cr_ref_payable'],
+                'dr_reserve_ref': value['dr_reserve_ref'],
+                'dr_contra_rev': value['dr_contra_rev'],
+                'dr_defrev': value['dr_defrev'],
+                'dr_reserve_graceperiod': value['dr_reserve_graceperiod'],
+                'cr_contra_rev': value['cr_contra_rev']
+            }
+        if date.day == monthrange(date.year, date.month)[1]:
+            rollup[key]['ending_defrev'] = value['ending_defrev']	
+    return rollup
+
+def fold_closed_months(monthly_schedule, open_start):
+    """Books the activity of closed months of a monthly schedule in the first open month,
+    so that closed months are never written to. Modifies the schedule in place.
+
+    :param monthly_schedule: Dictionary of debits and credits by month, see rollup_month.
+    :param open_start: First day of the open periods.
+    """
+    open_month = (open_start.year, open_start.month)
+    closed = sorted((tuple(int(x) for x in key.split('-')), key) for key in monthly_schedule
+                    if tuple(int(x) for x in key.split('-')) < open_month)
+    if not closed:
+        return
+
+    open_key = '%s-%s' % open_month
+    if open_key not in monthly_schedule:
+        monthly_schedule[open_key] = dict((field, 0) for field in FLOW_FIELDS)
+        monthly_schedule[open_key]['ending_defrev'] = monthly_schedule[closed[-1][1]]['ending_defrev']
+
+    target = monthly_schedule[open_key]
+    for month, key in closed:
+        values = monthly_schedule.pop(key)
+        for field in FLOW_FIELDS:
+            target[field] += values[field]
+
+"""
+-----------------------
+FIXED-POINT SCHEDULES
+-----------------------
+"""
+def to_units(amount, scale):
+    """
+    :param amount: An amount of money.
+    :param scale: Number of units per currency unit, e.g. 100 for cents.
+    :return int. The amount rounded to the nearest unit.
+    """
+    return int(round(amount * scale))
+
+def from_units(units, scale):
+    """
+    :param units: An amount in fixed-point units.
+    :param scale: Number of units per currency unit.
+    :return float. The amount in currency units.
+    """
+    return units / scale
+
+def fixed_schedule(revrec_schedule, scale=100):
+    """Converts a daily schedule to a compact fixed-point schedule: one array of
+    integer units per field, indexed by days since the first day of the schedule.
+
+    Flow fields are rounded on their running totals, i.e. each day gets the difference
+    between the rounded cumulative amounts through that day and through the day before.
+    The rounding remainders thereby land on deterministic days and the daily amounts
+    sum exactly to the rounded total, e.g. a $20 fee over 30 days amortizes to exactly
+    2000 cents. Balance fields are derived from the rounded flows, so that they tie out
+    to them in units: each day's balance is the cumulative rounded flow that moves it,
+    see BALANCE_FLOWS, plus the rounded running total of the changes that the flow does
+    not explain, e.g. the amount booked to deferred revenue on payment. A $33.33 item
+    thereby has 3333 - 152 = 3181 units of deferred revenue after 152 units of dr_defrev.
+    Days without a row keep the previous balance.
+
+    :param revrec_schedule: Dictionary of debits and credits by day.
+    :param scale: Number of units per currency unit, e.g. 100 for cents.
+    :return dict. 'start' is the first day, 'days' the number of days, 'scale' the scale,
+                  and every schedule field maps to an array of integer units.
+    """
+    start = min(revrec_schedule.keys())
+    days = days_elapsed(start, max(revrec_schedule.keys()))
+    rows = [revrec_schedule.get(start + timedelta(n)) for n in range(days)]
+
+    # Typecode 'l' is a 64-bit signed integer on LP64 platforms.
+    fixed = {'start': start, 'days': days, 'scale': scale}
+    for field in FLOW_FIELDS:
+        units = array('l')
+        cumul = 0
+        cumul_units = 0
+        for row in rows:
+            if row is not None:
+                cumul += row[field]
+            rounded = to_units(cumul, scale)
+            units.append(rounded - cumul_units)
+            cumul_units = rounded
+        fixed[field] = units
+    for field in BALANCE_FIELDS:
+        flow, sign = BALANCE_FLOWS[field]
+        units = array('l')
+        balance = 0
+        other = 0
+        flow_units = 0
+        for row, delta in zip(rows, fixed[flow]):
+            if row is not None:
+                other += row[field] - balance - sign * row[flow]
+                balance = row[field]
+            flow_units += delta
+            units.append(to_units(other, scale) + sign * flow_units)
+        fixed[field] = units
+    return fixed
+
+def merge_fixed_schedules(fixed_schedules, scale=100):
+    """Sums fixed schedules on the union of their day axes. As in merge_schedules, a
+    schedule adds its last balance to the balance fields of the days past its end.
+
+    :param fixed_schedules: List of fixed schedules with the same scale, see fixed_schedule.
+    :param scale: Scale of the schedules. Used when the list is empty.
+    :return dict. Fixed schedule of the totals.
+    """
+    if not fixed_schedules:
+        return {'start': None, 'days': 0, 'scale': scale}
+
+    start = min(f['start'] for f in fixed_schedules)
+    end = max(f['start'] + timedelta(f['days'] - 1) for f in fixed_schedules)
+    days = days_elapsed(start, end)
+
+    merged = {'start': start, 'days': days, 'scale': scale}
+    for field in FLOW_FIELDS + BALANCE_FIELDS:
+        total = array('l', [0]) * days
+        for f in fixed_schedules:
+            offset = (f['start'] - start).days
+            for n, units in enumerate(f[field]):
+                total[offset + n] += units
+            if field in BALANCE_FIELDS and f['days']:
+                for n in range(offset + f['days'], days):
+                    total[n] += f[field][-1]
+        merged[field] = total
+    return merged
+
+def rollup_month_fixed(fixed):
+    """Rolls up a fixed schedule to months with exact integer sums. Same conventions
+    as rollup_month: keyed on month, i.e. '2012-1', and ending_defrev is the balance
+    on the last day of the month if the schedule covers it, else 0.
+
+    :param fixed: Fixed schedule, see fixed_schedule.
+    :return dict. Dictionary of debits and credits in integer units by month.
+    """
+    rollup = {}
+    for n in range(fixed['days']):
+        date = fixed['start'] + timedelta(n)
+        key = '%s-%s' % (date.year, date.month)
+        try:
+            month = rollup[key]
+        except KeyError:
+            month = rollup[key] = dict((field, 0) for field in FLOW_FIELDS)
+            month['ending_defrev'] = 0
+        for field in FLOW_FIELDS:
+            month[field] += fixed[field][n]
+        if date.day == monthrange(date.year, date.month)[1]:
+            month['ending_defrev'] = fixed['ending_defrev'][n]
+    return rollup
\ No newline at end of file